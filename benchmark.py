@@ -0,0 +1,107 @@
+# SCP-079-LONG - Control super long messages
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-LONG.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compare the regex engines on the rule sets in the data directory, and with trying the rules one by one
+# Usage: python benchmark.py [text files...]
+
+import pickle
+import sys
+from os import listdir
+from os.path import exists
+from random import choice, randint, seed
+from time import perf_counter
+
+from plugins.functions.rules import compile_rules, get_engine, match_rules
+
+
+def get_texts(paths: list) -> list:
+    # Get the texts to check, generate some long texts if there is no file
+    if paths:
+        texts = []
+
+        for path in paths:
+            with open(path, "r", encoding="utf-8") as f:
+                texts.append(f.read())
+
+        return texts
+
+    seed(79)
+    chars = "abcdefghijklmnopqrstuvwxyz0123456789 \n@.:/" + "".join(chr(c) for c in range(0x4E00, 0x4E00 + 500))
+
+    return ["".join(choice(chars) for _ in range(randint(2000, 4000))) for _ in range(20)]
+
+
+def get_words() -> dict:
+    # Get the rule sets
+    result = {}
+
+    if not exists("data"):
+        return result
+
+    for file in sorted(listdir("data")):
+        if not file.endswith("_words") or file.startswith("."):
+            continue
+
+        with open(f"data/{file}", "rb") as f:
+            words = pickle.load(f)
+
+        if words:
+            result[file.split("_")[0]] = list(words)
+
+    return result
+
+
+def main() -> None:
+    # Compile and match every rule set with every installed engine
+    texts = get_texts(sys.argv[1:])
+    words = get_words()
+
+    if not words:
+        print("No rules in data/*_words")
+        return
+
+    engines = [engine for engine in ["re", "regex", "re2"] if get_engine(engine)]
+    print(f"{'type':<6}{'rules':>7}  {'engine':<7}{'native':>8}{'fused':>7}{'compile ms':>12}{'loop ms':>9}"
+          f"{'match ms':>10}{'hits':>6}")
+
+    for word_type in words:
+        for engine in engines:
+            start = perf_counter()
+            rules = compile_rules(words[word_type], 0, engine)
+            compile_time = perf_counter() - start
+            native = sum(rule.engine == engine for rule in rules.rules)
+            fused = sum(len(chunk.rules) for chunk in rules.fused)
+
+            # The old way, every rule is tried one by one
+            start = perf_counter()
+            loop_hits = sum(any(rule.pattern.search(text) for rule in rules.rules) for text in texts)
+            loop_time = perf_counter() - start
+
+            start = perf_counter()
+            hits = sum(bool(match_rules(rules, text)) for text in texts)
+            match_time = perf_counter() - start
+
+            print(f"{word_type:<6}{len(words[word_type]):>7}  {engine:<7}{native:>8}{fused:>7}"
+                  f"{compile_time * 1000:>12.1f}{loop_time * 1000:>9.1f}{match_time * 1000:>10.1f}{hits:>6}")
+
+            if loop_hits != hits:
+                print(f"{word_type}: {loop_hits} hits by the loop, {hits} hits by the rules")
+
+
+if __name__ == "__main__":
+    main()
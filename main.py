@@ -26,7 +26,11 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from telegram.ext import Updater
 
 from plugins import glovar
-from plugins.functions.timers import backup_files, interval_min_10, reset_data, send_count, update_admins, update_status
+from plugins.functions.database import init_database
+from plugins.functions.file import load_user_buckets, save, save_dirty
+from plugins.functions.ids import replay_user_ids
+from plugins.functions.timers import backup_files, interval_min_1, interval_min_10, reset_data, send_count
+from plugins.functions.timers import send_profile, sweep_users, update_admins, update_status
 from plugins.handlers.command import add_command_handlers
 from plugins.handlers.error import add_error_handlers
 from plugins.handlers.message import add_message_handlers
@@ -34,6 +38,13 @@ from plugins.handlers.message import add_message_handlers
 # Enable logging
 logger = logging.getLogger(__name__)
 
+# Load the users' data buckets and replay the journal
+load_user_buckets()
+replay_user_ids()
+
+# Open the database if it is used
+init_database()
+
 # Config session
 updater = Updater(
     token=glovar.bot_token,
@@ -52,10 +63,14 @@ update_status(updater.bot, "online")
 
 # Timer
 scheduler = BackgroundScheduler(job_defaults={"misfire_grace_time": 60})
+scheduler.add_job(save_dirty, "interval", seconds=glovar.time_save)
+scheduler.add_job(interval_min_1, "interval", [updater.bot], minutes=1)
 scheduler.add_job(interval_min_10, "interval", minutes=10)
+scheduler.add_job(sweep_users, "interval", minutes=30)
 scheduler.add_job(update_status, "cron", [updater.bot, "awake"], minute=randint(30, 34), second=randint(0, 59))
 scheduler.add_job(backup_files, "cron", [updater.bot], hour=20)
 scheduler.add_job(send_count, "cron", [updater.bot], hour=21)
+scheduler.add_job(send_profile, "cron", [updater.bot], hour=21, minute=30)
 scheduler.add_job(reset_data, "cron", [updater.bot], day=glovar.date_reset, hour=22)
 scheduler.add_job(update_admins, "cron", [updater.bot], hour=22, minute=30)
 scheduler.start()
@@ -65,3 +80,8 @@ updater.idle()
 
 # Stop
 updater.stop()
+scheduler.shutdown()
+
+# Save regex count and other dirty data
+save("regex_counts")
+save_dirty()
@@ -24,7 +24,8 @@ from telegram import Bot, Chat, Message
 
 from .. import glovar
 from .etc import code, code_block, general_link, get_forward_name, get_full_name, lang, message_link, thread
-from .file import crypt_file, data_to_file, delete_file, get_new_path, save
+from .file import crypt_file, data_to_file, delete_file, get_new_path
+from .ids import get_user_status, update_user_id
 from .telegram import get_group_info, send_document, send_message
 
 # Enable logging
@@ -377,6 +378,29 @@ def share_regex_count(client: Bot, word_type: str) -> bool:
     return False
 
 
+def share_regex_profile(client: Bot, data: dict) -> bool:
+    # Use this function to share the slowest regex rules to REGEX
+    try:
+        if not data:
+            return True
+
+        file = data_to_file(data)
+        share_data(
+            client=client,
+            receivers=["REGEX"],
+            action="regex",
+            action_type="profile",
+            data="profile",
+            file=file
+        )
+
+        return True
+    except Exception as e:
+        logger.warning(f"Share regex profile error: {e}", exc_info=True)
+
+    return False
+
+
 def share_watch_user(client: Bot, the_type: str, uid: int, until: str) -> bool:
     # Share a watch ban user with other bots
     try:
@@ -402,10 +426,9 @@ def share_watch_user(client: Bot, the_type: str, uid: int, until: str) -> bool:
 def update_score(client: Bot, uid: int) -> bool:
     # Update a user's score, share it
     try:
-        count = len(glovar.user_ids[uid]["detected"])
+        count = len(get_user_status(uid).detected)
         score = count * 0.6
-        glovar.user_ids[uid]["score"][glovar.sender.lower()] = score
-        save("user_ids")
+        update_user_id(uid, "score", glovar.sender.lower(), score)
         share_data(
             client=client,
             receivers=glovar.receivers["score"],
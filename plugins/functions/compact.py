@@ -0,0 +1,270 @@
+# SCP-079-LONG - Control super long messages
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-LONG.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+from array import array
+from bisect import bisect_left
+from collections import deque
+from heapq import merge
+from threading import Lock
+from types import MappingProxyType
+from typing import Dict, Iterable, Iterator, Mapping, Optional, Sequence, Union
+
+# Enable logging
+logger = logging.getLogger(__name__)
+
+# This module must not import glovar, the classes are used by glovar when the data is loaded
+
+
+class IdSet:
+    # A set of int64 ids, kept in a sorted array with small sets of the changes since the last merge
+    __slots__ = ("added", "base", "lock", "removed")
+
+    def __init__(self, ids: Iterable[int] = ()):
+        self.added = set()
+        self.base = array("q", sorted(set(ids)))
+        self.lock = Lock()
+        self.removed = set()
+
+    def __bool__(self) -> bool:
+        return bool(self.added) or len(self.base) > len(self.removed)
+
+    def __contains__(self, the_id: int) -> bool:
+        if the_id in self.added:
+            return True
+
+        if the_id in self.removed:
+            return False
+
+        return self.in_base(the_id)
+
+    def __getstate__(self) -> tuple:
+        # Merge before pickled, so only the array is saved
+        self.merge()
+
+        return self.base.tobytes(),
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(merge((i for i in self.base if i not in self.removed), sorted(self.added)))
+
+    def __len__(self) -> int:
+        return len(self.base) - len(self.removed) + len(self.added)
+
+    def __setstate__(self, state: tuple) -> None:
+        self.added = set()
+        self.base = array("q")
+        self.base.frombytes(state[0])
+        self.lock = Lock()
+        self.removed = set()
+
+    def add(self, the_id: int) -> None:
+        # Add an id
+        with self.lock:
+            self.removed.discard(the_id)
+            self.in_base(the_id) or self.added.add(the_id)
+
+        len(self.added) > 4096 and self.merge()
+
+    def discard(self, the_id: int) -> None:
+        # Remove an id if it is present
+        with self.lock:
+            self.added.discard(the_id)
+            self.in_base(the_id) and self.removed.add(the_id)
+
+        len(self.removed) > 4096 and self.merge()
+
+    def in_base(self, the_id: int) -> bool:
+        # Binary search the sorted array
+        i = bisect_left(self.base, the_id)
+
+        return i < len(self.base) and self.base[i] == the_id
+
+    def merge(self) -> bool:
+        # Merge the changes into the sorted array, the lookups without the lock still get the right result
+        try:
+            with self.lock:
+                if not self.added and not self.removed:
+                    return True
+
+                self.base = array("q", iter(self))
+                self.added = set()
+                self.removed = set()
+
+            return True
+        except Exception as e:
+            logger.warning(f"Merge error: {e}", exc_info=True)
+
+        return False
+
+
+class IdRing:
+    # A set of the latest ids, the oldest one is dropped when the capacity is reached
+    __slots__ = ("index", "lock", "ring")
+
+    def __init__(self, ids: Iterable[int] = (), capacity: int = 1000):
+        self.index = set()
+        self.lock = Lock()
+        self.ring = deque(maxlen=capacity)
+
+        for the_id in ids:
+            self.add(the_id)
+
+    def __contains__(self, the_id: int) -> bool:
+        return the_id in self.index
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(list(self.ring))
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def add(self, the_id: int) -> None:
+        # Add an id, drop the oldest one if the ring is full
+        with self.lock:
+            if the_id in self.index:
+                return
+
+            len(self.ring) == self.ring.maxlen and self.index.discard(self.ring.popleft())
+            self.ring.append(the_id)
+            self.index.add(the_id)
+
+
+class UserStatus:
+    # A user's status, the scores of the projects are kept in a fixed order array,
+    # the dicts and the array are only allocated when they are written, most users never get any data
+    __slots__ = ("_detected", "_join", "_scores")
+
+    projects = ("captcha", "clean", "lang", "long", "noflood", "noporn", "nospam", "recheck", "warn")
+    indexes = {project: i for i, project in enumerate(projects)}
+    empty = MappingProxyType({})
+
+    def __init__(self):
+        self._detected: Optional[Dict[int, int]] = None
+        self._join: Optional[Dict[int, int]] = None
+        self._scores: Optional[array] = None
+
+    def __getstate__(self) -> tuple:
+        # Save the scores by the project names, so the order of the projects can be changed
+        return self._detected, self._join, self.get_scores()
+
+    def __setstate__(self, state: tuple) -> None:
+        detected, join, scores = state
+        self._detected = detected or None
+        self._join = join or None
+        self._scores = None
+
+        for project in scores:
+            self.set_score(project, scores[project])
+
+    @property
+    def detected(self) -> Mapping[int, int]:
+        # The detected time of the groups, do not change it, use set_detected instead
+        return self._detected or self.empty
+
+    @property
+    def join(self) -> Mapping[int, int]:
+        # The join time of the groups, do not change it, use set_join or pop_join instead
+        return self._join or self.empty
+
+    @property
+    def scores(self) -> Sequence[float]:
+        # The scores in the order of the projects, empty if no score is set
+        return self._scores or ()
+
+    @classmethod
+    def from_dict(cls, data: Union[dict, "UserStatus"]) -> "UserStatus":
+        # Get a user's status from the dict used by the old versions
+        if isinstance(data, cls):
+            return data
+
+        result = cls()
+        result._detected = dict(data.get("detected", {})) or None
+        result._join = dict(data.get("join", {})) or None
+
+        for project, score in data.get("score", {}).items():
+            result.set_score(project, score)
+
+        return result
+
+    def get_score(self, project: str) -> float:
+        # Get the score of a project
+        i = self.indexes.get(project)
+
+        return (i is not None and self._scores and self._scores[i]) or 0.0
+
+    def get_scores(self) -> Dict[str, float]:
+        # Get the scores that are not zero
+        return {project: score for project, score in zip(self.projects, self.scores) if score}
+
+    def get_total(self) -> float:
+        # Get the total score
+        return sum(self.scores, 0.0)
+
+    def pop_join(self, gid: int) -> Optional[int]:
+        # Remove the join time of a group, free the dict when it is empty
+        if not self._join:
+            return None
+
+        result = self._join.pop(gid, None)
+        self._join = self._join or None
+
+        return result
+
+    def set_detected(self, gid: int, value: int) -> bool:
+        # Set the detected time of a group
+        if self._detected is None:
+            self._detected = {}
+
+        self._detected[gid] = value
+
+        return True
+
+    def set_join(self, gid: int, value: int) -> bool:
+        # Set the join time of a group
+        if self._join is None:
+            self._join = {}
+
+        self._join[gid] = value
+
+        return True
+
+    def set_score(self, project: str, score: float) -> bool:
+        # Set the score of a project, the unknown projects are ignored
+        i = self.indexes.get(project)
+
+        if i is None:
+            return False
+
+        if self._scores is None:
+            # Setting a zero score to a user without scores changes nothing
+            if not score:
+                return True
+
+            self._scores = array("d", bytes(8 * len(self.projects)))
+
+        self._scores[i] = score
+
+        return True
+
+    def to_dict(self) -> dict:
+        # Get the dict used by the old versions
+        return {
+            "detected": dict(self.detected),
+            "join": dict(self.join),
+            "score": {project: self.get_score(project) for project in self.projects}
+        }
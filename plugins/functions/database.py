@@ -0,0 +1,351 @@
+# SCP-079-LONG - Control super long messages
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-LONG.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import sqlite3
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Union
+
+from .. import glovar
+from .compact import IdSet, UserStatus
+
+# Enable logging
+logger = logging.getLogger(__name__)
+
+# The key and value columns have no type, so the ints and floats are kept as they are
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bad (type TEXT NOT NULL, id INTEGER NOT NULL, PRIMARY KEY (type, id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS users (uid INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS status (uid INTEGER NOT NULL, type TEXT NOT NULL, key NOT NULL, value NOT NULL,
+                                   PRIMARY KEY (uid, type, key)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS status_key ON status (type, key);
+CREATE TABLE IF NOT EXISTS watch (type TEXT NOT NULL, uid INTEGER NOT NULL, until INTEGER NOT NULL,
+                                  PRIMARY KEY (type, uid)) WITHOUT ROWID;
+"""
+
+
+def add_bad(the_type: str, the_id: int) -> bool:
+    # Add a bad channel or user
+    result = execute("INSERT OR IGNORE INTO bad VALUES (?, ?)", [(the_type, the_id)])
+    pop_cache(("bad", the_type, the_id))
+
+    return result
+
+
+def clear_bad(the_type: str) -> bool:
+    # Clear the bad channels or users
+    result = execute("DELETE FROM bad WHERE type = ?", [(the_type,)])
+    clear_cache()
+
+    return result
+
+
+def clear_cache() -> bool:
+    # Clear the read cache
+    try:
+        with glovar.locks["database"]:
+            glovar.cached.clear()
+            glovar.cached_generation += 1
+
+        return True
+    except Exception as e:
+        logger.warning(f"Clear cache error: {e}", exc_info=True)
+
+    return False
+
+
+def clear_users() -> bool:
+    # Clear all users' data
+    result = execute("DELETE FROM status", [()]) and execute("DELETE FROM users", [()])
+    clear_cache()
+
+    return result
+
+
+def clear_watch(the_type: str) -> bool:
+    # Clear the watch ban or watch delete users
+    result = execute("DELETE FROM watch WHERE type = ?", [(the_type,)])
+    clear_cache()
+
+    return result
+
+
+def execute(sql: str, params: Iterable[tuple]) -> bool:
+    # Execute a statement with each parameters in one transaction
+    try:
+        with glovar.locks["database"]:
+            with glovar.database:
+                glovar.database.executemany(sql, params)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Execute {sql} error: {e}", exc_info=True)
+
+    return False
+
+
+def expire_users(before: int, low: int, high: int) -> bool:
+    # Remove the join status before the time, drop the users with no data left, only for the uids in the range
+    result = (execute("DELETE FROM status WHERE uid BETWEEN ? AND ? AND type = 'join' AND value < ? "
+                      "AND NOT (EXISTS (SELECT 1 FROM status AS s WHERE s.uid = status.uid "
+                      "AND s.type = 'score' AND s.value != 0) "
+                      "AND value = (SELECT MAX(s.value) FROM status AS s "
+                      "WHERE s.uid = status.uid AND s.type = 'join'))",
+                      [(low, high, before)])
+              and execute("DELETE FROM users WHERE uid BETWEEN ? AND ? AND NOT EXISTS "
+                          "(SELECT 1 FROM status WHERE status.uid = users.uid AND (type != 'score' OR value != 0))",
+                          [(low, high)])
+              and execute("DELETE FROM status WHERE uid BETWEEN ? AND ? AND NOT EXISTS "
+                          "(SELECT 1 FROM users WHERE users.uid = status.uid)", [(low, high)]))
+    clear_cache()
+
+    return result
+
+
+def export_data(file: str) -> Union[Dict[str, Set[int]], Dict[int, UserStatus], Dict[str, Dict[int, int]]]:
+    # Export the stored data as the same structure as the pickled global variable
+    result = None
+    try:
+        if file == "bad_ids":
+            result = {"channels": set(), "users": set()}
+
+            for the_type, the_id in query("SELECT type, id FROM bad", ()):
+                result[the_type].add(the_id)
+        elif file == "user_ids":
+            result = {uid: UserStatus() for uid, in query("SELECT uid FROM users", ())}
+
+            for uid, the_type, key, value in query("SELECT uid, type, key, value FROM status", ()):
+                set_status(result.setdefault(uid, UserStatus()), the_type, key, value)
+        elif file == "watch_ids":
+            result = {"ban": {}, "delete": {}}
+
+            for the_type, uid, until in query("SELECT type, uid, until FROM watch", ()):
+                result[the_type][uid] = until
+    except Exception as e:
+        logger.warning(f"Export data {file} error: {e}", exc_info=True)
+
+    return result
+
+
+def get_bad(the_type: str, the_id: int) -> bool:
+    # Check if the channel or user is bad
+    return get_cached(("bad", the_type, the_id),
+                      lambda: bool(query("SELECT 1 FROM bad WHERE type = ? AND id = ?", (the_type, the_id))))
+
+
+def get_cached(key: tuple, getter: Callable[[], Any]) -> Any:
+    # Get a value from the read cache, get it from the database if it is not cached
+    with glovar.locks["database"]:
+        if key in glovar.cached:
+            glovar.cached.move_to_end(key)
+            return glovar.cached[key]
+
+        generation = glovar.cached_generation
+
+    value = getter()
+
+    with glovar.locks["database"]:
+        # The value may be changed and invalidated during the read, then it is not cached
+        if glovar.cached_generation != generation:
+            return value
+
+        glovar.cached[key] = value
+
+        while len(glovar.cached) > 10000:
+            glovar.cached.popitem(last=False)
+
+    return value
+
+
+def get_user(uid: int) -> Optional[UserStatus]:
+    # Get the user's status, None means there is no data of the user
+    return get_cached(("user", uid), lambda: query_user(uid))
+
+
+def get_uids(after: int, limit: int) -> List[int]:
+    # Get the users' ids after the id in order
+    return [uid for uid, in query("SELECT uid FROM users WHERE uid > ? ORDER BY uid LIMIT ?", (after, limit))]
+
+
+def get_watch(the_type: str, uid: int) -> int:
+    # Get the time until which the user is watched
+    return get_cached(("watch", the_type, uid),
+                      lambda: (query("SELECT until FROM watch WHERE type = ? AND uid = ?", (the_type, uid))
+                               or [(0,)])[0][0])
+
+
+def import_data(file: str, data: Union[Dict[str, Set[int]], Dict[int, UserStatus], Dict[str, Dict[int, int]]]) -> bool:
+    # Replace the stored data with the structure of the pickled global variable
+    try:
+        if file == "bad_ids":
+            for the_type in ["channels", "users"]:
+                clear_bad(the_type)
+                execute("INSERT OR IGNORE INTO bad VALUES (?, ?)", [(the_type, i) for i in data.get(the_type, set())])
+        elif file == "user_ids":
+            data = {uid: UserStatus.from_dict(data[uid]) for uid in data}
+            clear_users()
+            execute("INSERT OR IGNORE INTO users VALUES (?)", [(uid,) for uid in data])
+            execute("INSERT OR REPLACE INTO status VALUES (?, ?, ?, ?)",
+                    [(uid, "detected", key, value) for uid in data for key, value in data[uid].detected.items()]
+                    + [(uid, "join", key, value) for uid in data for key, value in data[uid].join.items()]
+                    + [(uid, "score", key, value) for uid in data for key, value in data[uid].get_scores().items()])
+        elif file == "watch_ids":
+            for the_type in ["ban", "delete"]:
+                clear_watch(the_type)
+                execute("INSERT OR REPLACE INTO watch VALUES (?, ?, ?)",
+                        [(the_type, uid, until) for uid, until in data.get(the_type, {}).items()])
+
+        clear_cache()
+
+        return True
+    except Exception as e:
+        logger.warning(f"Import data {file} error: {e}", exc_info=True)
+
+    return False
+
+
+def init_database() -> bool:
+    # Open the database, move the pickled data into it if it is new
+    try:
+        if glovar.storage != "sqlite":
+            return True
+
+        glovar.database = sqlite3.connect("data/storage.db", check_same_thread=False)
+        glovar.database.execute("PRAGMA journal_mode = WAL")
+        glovar.database.execute("PRAGMA synchronous = NORMAL")
+        glovar.database.executescript(SCHEMA)
+
+        # Move the pickled data into the database only once, a table may be empty because it was cleared,
+        # the database made before the version was recorded has been moved if there is any data
+        if not query("PRAGMA user_version", ())[0][0]:
+            if not any(query(f"SELECT 1 FROM {table} LIMIT 1", ()) for table in ["bad", "users", "watch"]):
+                for file in ["bad_ids", "user_ids", "watch_ids"]:
+                    import_data(file, eval(f"glovar.{file}"))
+
+            glovar.database.execute("PRAGMA user_version = 1")
+
+        # The data is stored in the database only, do not keep it in memory
+        glovar.bad_ids = {"channels": set(), "users": IdSet()}
+        glovar.user_ids = {}
+        glovar.watch_ids = {"ban": {}, "delete": {}}
+
+        return True
+    except Exception as e:
+        logger.critical(f"Init database error: {e}", exc_info=True)
+        raise SystemExit("[DATABASE ERROR]")
+
+
+def init_user(uid: int) -> bool:
+    # Init the user's data
+    result = execute("INSERT OR IGNORE INTO users VALUES (?)", [(uid,)])
+    pop_cache(("user", uid))
+
+    return result
+
+
+def pop_cache(key: tuple) -> bool:
+    # Remove a value from the read cache
+    try:
+        with glovar.locks["database"]:
+            glovar.cached.pop(key, None)
+            glovar.cached_generation += 1
+
+        return True
+    except Exception as e:
+        logger.warning(f"Pop cache error: {e}", exc_info=True)
+
+    return False
+
+
+def query(sql: str, params: tuple) -> List[tuple]:
+    # Query the database
+    result = []
+    try:
+        with glovar.locks["database"]:
+            result = glovar.database.execute(sql, params).fetchall()
+    except Exception as e:
+        logger.warning(f"Query {sql} error: {e}", exc_info=True)
+
+    return result
+
+
+def query_user(uid: int) -> Optional[UserStatus]:
+    # Query the user's status
+    result = None
+    try:
+        if not query("SELECT 1 FROM users WHERE uid = ?", (uid,)):
+            return None
+
+        result = UserStatus()
+
+        for the_type, key, value in query("SELECT type, key, value FROM status WHERE uid = ?", (uid,)):
+            set_status(result, the_type, key, value)
+    except Exception as e:
+        logger.warning(f"Query user error: {e}", exc_info=True)
+
+    return result
+
+
+def remove_bad(the_type: str, the_id: int) -> bool:
+    # Remove a bad channel or user
+    result = execute("DELETE FROM bad WHERE type = ? AND id = ?", [(the_type, the_id)])
+    pop_cache(("bad", the_type, the_id))
+
+    return result
+
+
+def remove_watch(uid: int) -> bool:
+    # Remove the user from the watch lists
+    result = execute("DELETE FROM watch WHERE uid = ?", [(uid,)])
+    pop_cache(("watch", "ban", uid))
+    pop_cache(("watch", "delete", uid))
+
+    return result
+
+
+def reset_user(uid: int) -> bool:
+    # Reset the user's data
+    result = (execute("DELETE FROM status WHERE uid = ?", [(uid,)])
+              and execute("INSERT OR IGNORE INTO users VALUES (?)", [(uid,)]))
+    pop_cache(("user", uid))
+
+    return result
+
+
+def set_status(status: UserStatus, the_type: str, key: Union[int, str], value: Union[float, int]) -> bool:
+    # Set a row of the status table to the user's status
+    if the_type == "score":
+        return status.set_score(key, value)
+
+    return eval(f"status.set_{the_type}")(key, value)
+
+
+def set_user(uid: int, the_type: str, key: Union[int, str], value: Union[float, int]) -> bool:
+    # Set the user's detected, join or score data
+    result = (execute("INSERT OR IGNORE INTO users VALUES (?)", [(uid,)])
+              and execute("INSERT OR REPLACE INTO status VALUES (?, ?, ?, ?)", [(uid, the_type, key, value)]))
+    pop_cache(("user", uid))
+
+    return result
+
+
+def set_watch(the_type: str, uid: int, until: int) -> bool:
+    # Set the time until which the user is watched
+    result = execute("INSERT OR REPLACE INTO watch VALUES (?, ?, ?)", [(the_type, uid, until)])
+    pop_cache(("watch", the_type, uid))
+
+    return result
@@ -24,11 +24,10 @@ from random import choice
 from string import ascii_letters, digits
 from threading import Thread, Timer
 from time import localtime, strftime, time
-from typing import Any, Callable, Optional, Union
+from typing import Any, Callable, List, Optional, Union
 from unicodedata import normalize
 
 from cryptography.fernet import Fernet
-from opencc import convert
 from telegram import Message, User
 
 from .. import glovar
@@ -37,6 +36,73 @@ from .. import glovar
 logger = logging.getLogger(__name__)
 
 
+class MessageView:
+    # The texts and names of one message, each of them is only got once when it is first used
+    def __init__(self, message: Message):
+        self.message = message
+        self._forward_name: Optional[str] = None
+        self._length: Optional[int] = None
+        self._name: Optional[str] = None
+        self._normal_text: Optional[str] = None
+        self._text: Optional[str] = None
+
+    def below(self, limit: int) -> bool:
+        # Check if the UTF-8 bytes length is below the limit, the exact length is only got if it is necessary
+        if self._length is not None:
+            return self._length < limit
+
+        # Every character is encoded into 1 to 4 bytes
+        count = len(self.text)
+
+        if count * 4 < limit:
+            return True
+
+        if count >= limit:
+            return False
+
+        return self.length < limit
+
+    @property
+    def forward_name(self) -> str:
+        # The normalized name of the forwarded message's origin sender
+        if self._forward_name is None:
+            self._forward_name = get_forward_name(self.message, True, True)
+
+        return self._forward_name
+
+    @property
+    def length(self) -> int:
+        # The UTF-8 bytes length of the raw text
+        if self._length is None:
+            self._length = get_length(self.text)
+
+        return self._length
+
+    @property
+    def name(self) -> str:
+        # The normalized full name of the sender
+        if self._name is None:
+            self._name = get_full_name(self.message.from_user, True, True)
+
+        return self._name
+
+    @property
+    def normal_text(self) -> str:
+        # The normalized and printable text
+        if self._normal_text is None:
+            self._normal_text = get_text(self.message, True, True)
+
+        return self._normal_text
+
+    @property
+    def text(self) -> str:
+        # The raw text
+        if self._text is None:
+            self._text = get_text(self.message)
+
+        return self._text
+
+
 def bold(text: Any) -> str:
     # Get a bold text
     try:
@@ -213,7 +279,7 @@ def get_forward_name(message: Message, normal: bool = False, printable: bool = F
             text = chat.title
 
         if text:
-            text = t2t(text, normal, printable)
+            text = get_name_text(text, normal, printable)
     except Exception as e:
         logger.warning(f"Get forward name error: {e}", exc_info=True)
 
@@ -233,7 +299,7 @@ def get_full_name(user: User, normal: bool = False, printable: bool = False) ->
             text += f" {user.last_name}"
 
         if text and normal:
-            text = t2t(text, normal, printable)
+            text = get_name_text(text, normal, printable)
     except Exception as e:
         logger.warning(f"Get full name error: {e}", exc_info=True)
 
@@ -251,6 +317,45 @@ def get_int(text: str) -> Optional[int]:
     return result
 
 
+def get_length(text: str) -> int:
+    # Get the UTF-8 bytes length of the text, encode it in chunks to avoid copying the whole text
+    result = 0
+    try:
+        for i in range(0, len(text), 4096):
+            result += len(text[i:i + 4096].encode())
+    except Exception as e:
+        logger.warning(f"Get length error: {e}", exc_info=True)
+
+    return result
+
+
+def get_name_text(text: str, normal: bool, printable: bool) -> str:
+    # Get the converted name from the cache, convert it if it is not cached
+    result = text
+    glovar.locks["name"].acquire()
+    try:
+        key = (text, normal, printable)
+        cached = glovar.names.get(key)
+
+        if cached is not None:
+            glovar.names.move_to_end(key)
+            glovar.names_stats["hit"] += 1
+            return cached
+
+        glovar.names_stats["miss"] += 1
+        result = t2t(text, normal, printable)
+        glovar.names[key] = result
+
+        while len(glovar.names) > glovar.name_cache:
+            glovar.names.popitem(last=False)
+    except Exception as e:
+        logger.warning(f"Get name text error: {e}", exc_info=True)
+    finally:
+        glovar.locks["name"].release()
+
+    return result
+
+
 def get_now() -> int:
     # Get time for now
     result = 0
@@ -297,6 +402,27 @@ def get_text(message: Message, normal: bool = False, printable: bool = False) ->
     return text
 
 
+def get_text_chunks(text: str, size: int) -> List[str]:
+    # Split the text into chunks no longer than the size, prefer to split after a separator
+    result = []
+    try:
+        start = 0
+
+        while len(text) - start > size:
+            end = start + size
+            cut = max(text.rfind(separator, start + size // 2, end) for separator in "\n 。！？，；")
+            end = (cut >= 0 and cut + 1) or end
+            result.append(text[start:end])
+            start = end
+
+        result.append(text[start:])
+    except Exception as e:
+        logger.warning(f"Get text chunks error: {e}", exc_info=True)
+        result = [text]
+
+    return result
+
+
 def lang(text: str) -> str:
     # Get the text
     result = ""
@@ -342,6 +468,37 @@ def random_str(i: int) -> str:
     return text
 
 
+def t2s(text: str) -> str:
+    # Convert traditional Chinese to simplified Chinese
+    result = text
+    glovar.locks["convert"].acquire()
+    try:
+        # Short strings such as names and short messages repeat a lot
+        short = len(text) <= 256
+
+        if short:
+            cached = glovar.converted.get(text)
+
+            if cached is not None:
+                glovar.converted.move_to_end(text)
+                return cached
+
+        # The converter can not handle the text in a thread-safe way, so it is used with the lock
+        result = "".join(glovar.converter.convert(chunk) for chunk in get_text_chunks(text, 4096))
+
+        if short:
+            glovar.converted[text] = result
+
+            while len(glovar.converted) > 10000:
+                glovar.converted.popitem(last=False)
+    except Exception as e:
+        logger.warning(f"T2S error: {e}", exc_info=True)
+    finally:
+        glovar.locks["convert"].release()
+
+    return result
+
+
 def t2t(text: str, normal: bool, printable: bool) -> str:
     # Convert the string, text to text
     try:
@@ -350,7 +507,7 @@ def t2t(text: str, normal: bool, printable: bool) -> str:
 
         if normal:
             for special in ["spc", "spe"]:
-                text = "".join(eval(f"glovar.{special}_dict").get(t, t) for t in text)
+                text = text.translate(eval(f"glovar.{special}_table"))
 
             text = normalize("NFKC", text)
 
@@ -358,7 +515,7 @@ def t2t(text: str, normal: bool, printable: bool) -> str:
             text = "".join(t for t in text if t.isprintable() or t in {"\n", "\r", "\t"})
 
         if normal and glovar.zh_cn:
-            text = convert(text, config="t2s.json")
+            text = t2s(text)
     except Exception as e:
         logger.warning(f"T2T error: {e}", exc_info=True)
 
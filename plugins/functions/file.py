@@ -17,22 +17,58 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-from os import remove
+import lzma
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from os import listdir, mkdir, remove, replace
 from os.path import exists
-from pickle import dump
-from shutil import copyfile
-from typing import Any
+from pickle import UnpicklingError, dump, load, loads
+from shutil import copyfile, copyfileobj
+from typing import Any, Callable, List
 
 from pyAesCrypt import decryptFile, encryptFile
 from telegram import Bot
 
 from .. import glovar
-from .etc import random_str, thread
+from .compact import UserStatus
+from .etc import random_str
 from .telegram import download_media
 
 # Enable logging
 logger = logging.getLogger(__name__)
 
+# A pickle never starts with a null byte, so the compressed files can be told from the old ones
+COMPRESS_HEADER = b"\x00079"
+
+
+def compress_file(path: str) -> str:
+    # Compress a pickled file to a new file in tmp directory, keep the file if compression does not help
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+
+        # Small files are compressed fast by zlib, large files get the better ratio of lzma
+        if len(data) < 1024 * 1024:
+            method, compressed = b"z", zlib.compress(data, 9)
+        else:
+            method, compressed = b"x", lzma.compress(data)
+
+        if len(compressed) + len(COMPRESS_HEADER) + 1 >= len(data):
+            return path
+
+        file_path = get_new_path()
+
+        with open(file_path, "wb") as f:
+            f.write(COMPRESS_HEADER + method + compressed)
+
+        path.startswith("tmp/") and delete_file(path)
+
+        return file_path
+    except Exception as e:
+        logger.warning(f"Compress file error: {e}", exc_info=True)
+
+    return path
+
 
 def crypt_file(operation: str, file_in: str, file_out: str) -> bool:
     # Encrypt or decrypt a file
@@ -113,10 +149,172 @@ def get_new_path(extension: str = "") -> str:
     return result
 
 
+def journal(file: str, record: tuple, apply: Callable[[tuple], bool] = None) -> bool:
+    # Apply a mutation record to a global variable and append it to its journal in one critical section,
+    # so the journal has the same order as the changes in memory, compact the journal if it is too long
+    try:
+        with glovar.locks["journal"]:
+            apply and apply(record)
+
+            with open(f"data/{file}.journal", "ab") as f:
+                dump(record, f)
+
+            glovar.journal_counts[file] = glovar.journal_counts.get(file, 0) + 1
+
+            if glovar.journal_counts[file] < 10000:
+                return True
+
+            glovar.journal_counts[file] = 0
+
+        return save(file)
+    except Exception as e:
+        logger.warning(f"Journal error: {e}", exc_info=True)
+
+    return False
+
+
+def load_file(path: str) -> Any:
+    # Load a pickled file, the compressed file starts with a header, the old files are plain pickles
+    with open(path, "rb") as f:
+        if f.read(len(COMPRESS_HEADER)) != COMPRESS_HEADER:
+            f.seek(0)
+            return load(f)
+
+        method = f.read(1)
+        data = f.read()
+
+    if method == b"z":
+        return loads(zlib.decompress(data))
+    elif method == b"x":
+        return loads(lzma.decompress(data))
+
+    raise UnpicklingError(f"Unknown compression method {method}")
+
+
+def load_user_buckets() -> bool:
+    # Load the users' data from the bucket files in parallel, the single file of the old versions is loaded by glovar
+    try:
+        if not exists("data/user_ids.d"):
+            # The database keeps the users' data, the buckets are only made for the pickle storage
+            if glovar.storage == "sqlite":
+                return True
+
+            # Move the single file away after its data is in the buckets, so it is never loaded again
+            mark_user_bucket()
+
+            if not save_buckets():
+                return False
+
+            for path in ["data/user_ids", "data/.user_ids"]:
+                exists(path) and replace(path, f"{path}.old")
+
+            return True
+
+        # The buckets beyond the count were saved with a larger count before, they are older, so they are loaded first
+        indexes = sorted((int(name) for name in listdir("data/user_ids.d") if name.isdigit()),
+                         key=lambda i: (i < glovar.bucket_count, i))
+        paths = [f"data/user_ids.d/{index}" for index in indexes]
+
+        with ThreadPoolExecutor() as executor:
+            buckets = list(executor.map(load_file, paths))
+
+        user_ids = {}
+        moved = False
+
+        # The buckets saved by the old versions contain dicts
+        for index, bucket in zip(indexes, buckets):
+            user_ids.update((uid, UserStatus.from_dict(bucket[uid])) for uid in bucket)
+            moved = moved or any(uid % glovar.bucket_count != index for uid in bucket)
+
+        glovar.user_ids = user_ids
+
+        if not moved:
+            return True
+
+        # The bucket count is changed, save all the users again, then remove the buckets beyond the count
+        mark_user_bucket()
+
+        if not save_buckets():
+            return False
+
+        for index in indexes:
+            index >= glovar.bucket_count and remove(f"data/user_ids.d/{index}")
+
+        return True
+    except Exception as e:
+        logger.critical(f"Load user buckets error: {e}", exc_info=True)
+        raise SystemExit("[DATA CORRUPTION]")
+
+
+def mark_user_bucket(uid: int = None) -> bool:
+    # Mark the bucket of the user as dirty, mark all buckets if the user is not given
+    try:
+        with glovar.locks["save"]:
+            if uid is None:
+                glovar.dirty_buckets.update(range(glovar.bucket_count))
+            else:
+                glovar.dirty_buckets.add(uid % glovar.bucket_count)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Mark user bucket error: {e}", exc_info=True)
+
+    return False
+
+
+def read_journal(file: str) -> List[tuple]:
+    # Read the mutation records of a global variable, including the ones rotated but not compacted yet
+    result = []
+    try:
+        for path in [f"data/{file}.journal.old", f"data/{file}.journal"]:
+            if not exists(path):
+                continue
+
+            with open(path, "rb") as f:
+                while True:
+                    try:
+                        result.append(load(f))
+                    except EOFError:
+                        break
+                    except UnpicklingError as e:
+                        logger.warning(f"Read journal {path} stopped at a broken record: {e}")
+                        break
+    except Exception as e:
+        logger.warning(f"Read journal error: {e}", exc_info=True)
+
+    return result
+
+
+def rotate_journal(file: str) -> bool:
+    # Move the journal aside before the snapshot is dumped, so the records appended later are kept
+    try:
+        with glovar.locks["journal"]:
+            glovar.journal_counts[file] = 0
+
+            if not exists(f"data/{file}.journal"):
+                return True
+
+            # The journal rotated by a failed compaction has not been compacted yet
+            if exists(f"data/{file}.journal.old"):
+                with open(f"data/{file}.journal.old", "ab") as f_old, open(f"data/{file}.journal", "rb") as f:
+                    copyfileobj(f, f_old)
+
+                remove(f"data/{file}.journal")
+            else:
+                replace(f"data/{file}.journal", f"data/{file}.journal.old")
+
+        return True
+    except Exception as e:
+        logger.warning(f"Rotate journal error: {e}", exc_info=True)
+
+    return False
+
+
 def save(file: str) -> bool:
-    # Save a global variable to a file
+    # Mark a global variable as dirty, it will be saved to a file by the writer
     try:
-        thread(save_thread, (file,))
+        with glovar.locks["save"]:
+            glovar.dirty.add(file)
 
         return True
     except Exception as e:
@@ -125,16 +323,86 @@ def save(file: str) -> bool:
     return False
 
 
+def save_buckets() -> bool:
+    # Save the dirty buckets of the users' data, each bucket is replaced atomically
+    buckets = set()
+    try:
+        # The users' data is not in memory when it is kept in the database, so the buckets are left as they are
+        if glovar.storage == "sqlite":
+            return True
+
+        with glovar.locks["save"]:
+            buckets = glovar.dirty_buckets
+            glovar.dirty_buckets = set()
+
+        if not buckets:
+            return True
+
+        data = {bucket: {} for bucket in buckets}
+
+        for uid, status in list(glovar.user_ids.items()):
+            bucket = uid % glovar.bucket_count
+            bucket in data and data[bucket].update({uid: status})
+
+        exists("data/user_ids.d") or mkdir("data/user_ids.d")
+
+        for bucket in data:
+            with open(f"data/user_ids.d/{bucket}.tmp", "wb") as f:
+                dump(data[bucket], f)
+
+            replace(f"data/user_ids.d/{bucket}.tmp", f"data/user_ids.d/{bucket}")
+
+        return True
+    except Exception as e:
+        logger.error(f"Save buckets error: {e}", exc_info=True)
+
+        with glovar.locks["save"]:
+            glovar.dirty_buckets |= buckets
+
+    return False
+
+
+def save_dirty() -> bool:
+    # Save the dirty global variables, each of them is only saved once no matter how many times it was marked
+    try:
+        with glovar.locks["save"]:
+            files = glovar.dirty
+            glovar.dirty = set()
+
+            # The changed buckets of the users' data are written by every run, not only when the journal is compacted
+            glovar.storage != "sqlite" and glovar.dirty_buckets and files.add("user_ids")
+
+        for file in files:
+            save_thread(file) or save(file)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Save dirty error: {e}", exc_info=True)
+
+    return False
+
+
 def save_thread(file: str) -> bool:
-    # Save thread
+    # Save a global variable to a file and its backup, replace the old files atomically
     try:
         if not glovar:
             return True
 
-        with open(f"data/.{file}", "wb") as f:
+        # The snapshot contains every record in the journal, the records appended after the rotation are kept
+        if not rotate_journal(file):
+            return False
+
+        # The users' data is saved in buckets, only the changed ones are written
+        if file == "user_ids":
+            return save_buckets() and delete_file(f"data/{file}.journal.old")
+
+        with open(f"data/.{file}.tmp", "wb") as f:
             dump(eval(f"glovar.{file}"), f)
 
-        copyfile(f"data/.{file}", f"data/{file}")
+        replace(f"data/.{file}.tmp", f"data/.{file}")
+        copyfile(f"data/.{file}", f"data/{file}.tmp")
+        replace(f"data/{file}.tmp", f"data/{file}")
+        delete_file(f"data/{file}.journal.old")
 
         return True
     except Exception as e:
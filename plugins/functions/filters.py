@@ -18,22 +18,28 @@
 
 import logging
 import re
-from copy import deepcopy
-from string import ascii_lowercase
-from typing import Match, Optional, Union
+from typing import Dict, List, Match, Optional, Set, Tuple, Union
 
 from telegram import Message, User
 from telegram.ext import BaseFilter
 
 from .. import glovar
-from .etc import get_now, get_int, get_forward_name, get_full_name, get_text
-from .file import save
-from .ids import init_group_id
+from .etc import MessageView, get_now, get_int
+from .ids import get_user_status, get_watch_until, init_group_id, is_bad_id
+from .rules import Rule, Suspect, compile_rules, compile_sweep, find_slow, match_rules, search_trie, sweep_rules
 
 # Enable logging
 logger = logging.getLogger(__name__)
 
 
+class Evaluation:
+    # The regex results of one update
+    def __init__(self):
+        self.ads: Dict[Tuple[str, bool], Set[str]] = {}
+        self.results: Dict[Tuple[str, str, bool], Optional[Match]] = {}
+        self.texts: Dict[str, Tuple[str, Optional[str]]] = {}
+
+
 class FilterAuthorizedGroup(BaseFilter):
     # Check if the message is send from the authorized group
     def filter(self, message: Message):
@@ -99,13 +105,13 @@ class FilterClassD(BaseFilter):
             if message.forward_from:
                 fid = message.forward_from.id
 
-                if fid in glovar.bad_ids["users"]:
+                if is_bad_id("users", fid):
                     return True
 
             if message.forward_from_chat:
                 cid = message.forward_from_chat.id
 
-                if cid in glovar.bad_ids["channels"]:
+                if is_bad_id("channels", cid):
                     return True
         except Exception as e:
             logger.warning(f"FilterClassD error: {e}", exc_info=True)
@@ -249,54 +255,119 @@ new_group = FilterNewGroup()
 test_group = FilterTestGroup()
 
 
-def is_ad_text(text: str, ocr: bool, matched: str = "") -> str:
-    # Check if the text is ad text
+def count_rule(word_type: str, word: str) -> bool:
+    # Count a hit of the rule, the counts are swapped out by merge_count under the same lock
+    try:
+        with glovar.locks["count"]:
+            counts = glovar.regex_counts.setdefault(word_type, {})
+            counts[word] = counts.get(word, 0) + 1
+
+        return True
+    except Exception as e:
+        logger.warning(f"Count rule error: {e}", exc_info=True)
+
+    return False
+
+
+def get_ad_types(text: str, ocr: bool, evaluation: Evaluation = None) -> Set[str]:
+    # Get the letters of all ad_ types that the text hits, in one pass
+    result = set()
     try:
         if not text:
-            return ""
+            return set()
+
+        key = (text, ocr)
+
+        if evaluation and key in evaluation.ads:
+            return evaluation.ads[key]
+
+        sweep = glovar.compiled_ad
+        slow = {}
+
+        # Profile the rules
+        times = {} if is_sample() else None
+
+        for the_text in get_regex_texts(text, evaluation):
+            if the_text is None:
+                continue
+
+            hits = sweep_rules(sweep, the_text, ocr, glovar.regex_budget / 1000, slow, times)
+
+            for word_type in hits:
+                if word_type[2:] in result:
+                    continue
+
+                # Count
+                rule, _ = hits[word_type]
+                count_rule(word_type, rule.word)
+                result.add(word_type[2:])
+
+        for word_type in slow:
+            slow[word_type] and quarantine_rules(word_type, slow[word_type])
+
+        times and profile_rules(times)
+
+        if evaluation:
+            evaluation.ads[key] = result
+    except Exception as e:
+        logger.warning(f"Get ad types error: {e}", exc_info=True)
+
+    return result
+
+
+def get_regex_texts(text: str, evaluation: Evaluation = None) -> Tuple[str, Optional[str]]:
+    # Get the texts to check, with spaces collapsed, and with spaces removed
+    result = (text, None)
+    try:
+        if evaluation and text in evaluation.texts:
+            return evaluation.texts[text]
 
-        for c in ascii_lowercase:
-            if c != matched and is_regex_text(f"ad{c}", text, ocr):
-                return c
+        the_text = re.sub(r"\s{2,}", " ", text)
+
+        if " " in the_text:
+            result = (the_text, re.sub(r"\s", "", the_text))
+        else:
+            result = (the_text, None)
+
+        if evaluation:
+            evaluation.texts[text] = result
     except Exception as e:
-        logger.warning(f"Is ad text error: {e}", exc_info=True)
+        logger.warning(f"Get regex texts error: {e}", exc_info=True)
 
-    return ""
+    return result
 
 
-def is_ban_text(text: str, ocr: bool, message: Message = None) -> bool:
+def is_ban_text(text: str, ocr: bool, view: MessageView = None, evaluation: Evaluation = None) -> bool:
     # Check if the text is ban text
     try:
-        if is_regex_text("ban", text, ocr):
+        if is_regex_text("ban", text, ocr, evaluation):
             return True
 
         # ad + con
-        ad = is_regex_text("ad", text, ocr)
-        con = is_con_text(text, ocr)
+        ad = is_regex_text("ad", text, ocr, evaluation)
+        con = is_con_text(text, ocr, evaluation)
 
         if ad and con:
             return True
 
         # emoji + con
-        emoji = is_emoji("ad", text, message)
+        emoji = is_emoji("ad", text, view)
 
         if emoji and con:
             return True
 
         # ad_ + con
-        ad = is_ad_text(text, ocr)
+        ads = get_ad_types(text, ocr, evaluation)
 
-        if ad and con:
+        if ads and con:
             return True
 
         # ad_ + emoji
-        if ad and emoji:
+        if ads and emoji:
             return True
 
         # ad_ + ad_
-        if ad:
-            ad = is_ad_text(text, ocr, ad)
-            return bool(ad)
+        return len(ads) >= 2
     except Exception as e:
         logger.warning(f"Is ban text error: {e}", exc_info=True)
 
@@ -332,13 +403,13 @@ def is_class_d(_, message: Message) -> bool:
         if message.forward_from:
             fid = message.forward_from.id
 
-            if fid in glovar.bad_ids["users"]:
+            if is_bad_id("users", fid):
                 return True
 
         if message.forward_from_chat:
             cid = message.forward_from_chat.id
 
-            if cid in glovar.bad_ids["channels"]:
+            if is_bad_id("channels", cid):
                 return True
     except Exception as e:
         logger.warning(f"Is class d error: {e}", exc_info=True)
@@ -354,7 +425,7 @@ def is_class_d_user(user: Union[int, User]) -> bool:
         else:
             uid = user.id
 
-        if uid in glovar.bad_ids["users"]:
+        if is_bad_id("users", uid):
             return True
     except Exception as e:
         logger.warning(f"Is class d user error: {e}", exc_info=True)
@@ -384,12 +455,12 @@ def is_class_e_user(user: Union[int, User]) -> bool:
     return False
 
 
-def is_con_text(text: str, ocr: bool) -> bool:
+def is_con_text(text: str, ocr: bool, evaluation: Evaluation = None) -> bool:
     # Check if the text is con text
     try:
-        if (is_regex_text("con", text, ocr)
-                or is_regex_text("iml", text, ocr)
-                or is_regex_text("pho", text, ocr)):
+        if (is_regex_text("con", text, ocr, evaluation)
+                or is_regex_text("iml", text, ocr, evaluation)
+                or is_regex_text("pho", text, ocr, evaluation)):
             return True
     except Exception as e:
         logger.warning(f"Is con text error: {e}", exc_info=True)
@@ -416,7 +487,7 @@ def is_declared_message(message: Message) -> bool:
 def is_declared_message_id(gid: int, mid: int) -> bool:
     # Check if the message's ID is declared by other bots
     try:
-        if mid in glovar.declared_message_ids.get(gid, set()):
+        if mid in glovar.declared_message_ids.get(gid, ()):
             return True
     except Exception as e:
         logger.warning(f"Is declared message id error: {e}", exc_info=True)
@@ -444,12 +515,12 @@ def is_detected_user(message: Message) -> bool:
 def is_detected_user_id(gid: int, uid: int, now: int) -> bool:
     # Check if the user_id is detected in the group
     try:
-        user_status = glovar.user_ids.get(uid, {})
+        user_status = get_user_status(uid)
 
         if not user_status:
             return False
 
-        status = user_status["detected"].get(gid, 0)
+        status = user_status.detected.get(gid, 0)
 
         if now - status < glovar.time_punish:
             return True
@@ -459,22 +530,20 @@ def is_detected_user_id(gid: int, uid: int, now: int) -> bool:
     return False
 
 
-def is_emoji(the_type: str, text: str, message: Message = None) -> bool:
-    # Check the emoji type
+def is_emoji(the_type: str, text: str, view: MessageView = None) -> bool:
+    # Check the emoji type, the raw text of the message is used if there is a view
     try:
-        if message:
-            text = get_text(message, False, False)
+        if view:
+            text = view.text
 
         emoji_dict = {}
-        emoji_set = {emoji for emoji in glovar.emoji_set if emoji in text and emoji not in glovar.emoji_protect}
-        emoji_old_set = deepcopy(emoji_set)
 
-        for emoji in emoji_old_set:
-            if any(emoji in emoji_old and emoji != emoji_old for emoji_old in emoji_old_set):
-                emoji_set.discard(emoji)
+        # Scan the text once, a ZWJ sequence is counted as one emoji instead of its parts
+        for emoji in search_trie(glovar.emoji_trie, text):
+            if emoji in glovar.emoji_protect:
+                continue
 
-        for emoji in emoji_set:
-            emoji_dict[emoji] = text.count(emoji)
+            emoji_dict[emoji] = emoji_dict.get(emoji, 0) + 1
 
         # Check ad
         if the_type == "ad":
@@ -509,12 +578,12 @@ def is_high_score_user(user: User) -> float:
             return 0.0
 
         uid = user.id
-        user_status = glovar.user_ids.get(uid, {})
+        user_status = get_user_status(uid)
 
         if not user_status:
             return 0.0
 
-        score = sum(user_status["score"].values())
+        score = user_status.get_total()
 
         if score >= 3.0:
             return score
@@ -535,23 +604,24 @@ def is_limited_user(gid: int, user: User, now: int, short: bool = True) -> bool:
                 return True
 
         uid = user.id
+        user_status = get_user_status(uid)
 
-        if not glovar.user_ids.get(uid, {}):
+        if not user_status:
             return False
 
-        if not glovar.user_ids[uid].get("join", {}):
+        if not user_status.join:
             return False
 
         if is_high_score_user(user) >= 1.8:
             return True
 
-        join = glovar.user_ids[uid]["join"].get(gid, 0)
+        join = user_status.join.get(gid, 0)
 
         if short and now - join < glovar.time_short:
             return True
 
-        track = [gid for gid in glovar.user_ids[uid]["join"]
-                 if now - glovar.user_ids[uid]["join"][gid] < glovar.time_track]
+        track = [gid for gid in user_status.join
+                 if now - user_status.join[gid] < glovar.time_track]
 
         if len(track) >= glovar.limit_track:
             return True
@@ -561,7 +631,7 @@ def is_limited_user(gid: int, user: User, now: int, short: bool = True) -> bool:
     return False
 
 
-def is_long_text(message: Message) -> int:
+def is_long_text(message: Message, evaluation: Evaluation = None, view: MessageView = None) -> int:
     # Check if the text is super long
     try:
         if not message.chat:
@@ -569,9 +639,10 @@ def is_long_text(message: Message) -> int:
 
         # Basic data
         gid = message.chat.id
+        view = view or MessageView(message)
 
         # Get text
-        text = get_text(message)
+        text = view.text
 
         if not text.strip():
             return 0
@@ -580,35 +651,35 @@ def is_long_text(message: Message) -> int:
         if is_detected_user(message):
             return 79
 
-        # Get length
-        length = len(text.encode())
-
         # Check limit
-        if length < glovar.configs[gid]["limit"]:
+        if view.below(glovar.configs[gid]["limit"]):
             return 0
 
+        # Get length
+        length = view.length
+
         # Work with NOSPAM
         if length <= 10000:
             # Check the forward from name:
-            forward_name = get_forward_name(message, True, True)
+            forward_name = view.forward_name
 
-            if is_nm_text(forward_name):
+            if is_nm_text(forward_name, evaluation):
                 return 0
 
             # Check the user's name:
-            name = get_full_name(message.from_user, True, True)
+            name = view.name
 
-            if is_nm_text(name):
+            if is_nm_text(name, evaluation):
                 return 0
 
             # Check the text
-            normal_text = get_text(message, True, True)
+            normal_text = view.normal_text
 
             if glovar.nospam_id in glovar.admin_ids[gid]:
-                if is_ban_text(normal_text, False):
+                if is_ban_text(normal_text, False, None, evaluation):
                     return 0
 
-                if is_regex_text("del", normal_text):
+                if is_regex_text("del", normal_text, False, evaluation):
                     return 0
 
             return length
@@ -625,24 +696,25 @@ def is_new_user(user: User, now: int, gid: int = 0, joined: bool = False) -> boo
             return False
 
         uid = user.id
+        user_status = get_user_status(uid)
 
-        if not glovar.user_ids.get(uid, {}):
+        if not user_status:
             return False
 
-        if not glovar.user_ids[uid].get("join", {}):
+        if not user_status.join:
             return False
 
         if joined:
             return True
 
         if gid:
-            join = glovar.user_ids[uid]["join"].get(gid, 0)
+            join = user_status.join.get(gid, 0)
 
             if now - join < glovar.time_new:
                 return True
         else:
-            for gid in list(glovar.user_ids[uid]["join"]):
-                join = glovar.user_ids[uid]["join"].get(gid, 0)
+            for gid in list(user_status.join):
+                join = user_status.join.get(gid, 0)
 
                 if now - join < glovar.time_new:
                     return True
@@ -652,12 +724,12 @@ def is_new_user(user: User, now: int, gid: int = 0, joined: bool = False) -> boo
     return False
 
 
-def is_nm_text(text: str) -> bool:
+def is_nm_text(text: str, evaluation: Evaluation = None) -> bool:
     # Check if the text is nm text
     try:
-        if (is_regex_text("nm", text)
-                or is_regex_text("bio", text)
-                or is_ban_text(text, False)):
+        if (is_regex_text("nm", text, False, evaluation)
+                or is_regex_text("bio", text, False, evaluation)
+                or is_ban_text(text, False, None, evaluation)):
             return True
     except Exception as e:
         logger.warning(f"Is nm text error: {e}", exc_info=True)
@@ -665,45 +737,70 @@ def is_nm_text(text: str) -> bool:
     return False
 
 
-def is_regex_text(word_type: str, text: str, ocr: bool = False, again: bool = False) -> Optional[Match]:
+def is_regex_text(word_type: str, text: str, ocr: bool = False, evaluation: Evaluation = None) -> Optional[Match]:
     # Check if the text hit the regex rules
     result = None
     try:
-        if text:
-            if not again:
-                text = re.sub(r"\s{2,}", " ", text)
-            elif " " in text:
-                text = re.sub(r"\s", "", text)
-            else:
-                return None
-        else:
+        if not text:
             return None
 
-        with glovar.locks["regex"]:
-            words = list(eval(f"glovar.{word_type}_words"))
+        key = (word_type, text, ocr)
+
+        if evaluation and key in evaluation.results:
+            return evaluation.results[key]
+
+        # The compiled rules are never changed after published, so there is no need to lock
+        rules = glovar.compiled.get(word_type)
+
+        if not rules:
+            return None
+
+        # Profile the rules
+        times = {} if is_sample() else None
 
-        for word in words:
-            if ocr and "(?# nocr)" in word:
+        # Try the text, then try again without spaces
+        slow = []
+
+        for the_text in get_regex_texts(text, evaluation):
+            if the_text is None:
+                continue
+
+            hit = match_rules(rules, the_text, ocr, glovar.regex_budget / 1000, slow, times)
+
+            if not hit:
                 continue
 
-            result = re.search(word, text, re.I | re.S | re.M)
+            # Count
+            rule, result = hit
+            count_rule(word_type, rule.word)
+            break
 
-            # Count and return
-            if result:
-                count = eval(f"glovar.{word_type}_words").get(word, 0)
-                count += 1
-                eval(f"glovar.{word_type}_words")[word] = count
-                save(f"{word_type}_words")
-                return result
+        slow and quarantine_rules(word_type, slow)
+        times and profile_rules({word_type: times})
 
-        # Try again
-        return is_regex_text(word_type, text, ocr, True)
+        if evaluation:
+            evaluation.results[key] = result
     except Exception as e:
         logger.warning(f"Is regex text error: {e}", exc_info=True)
 
     return result
 
 
+def is_sample() -> bool:
+    # Check if this check should be profiled
+    try:
+        if not glovar.regex_profile:
+            return False
+
+        glovar.regex_sample += 1
+
+        return glovar.regex_sample % glovar.regex_profile == 0
+    except Exception as e:
+        logger.warning(f"Is sample error: {e}", exc_info=True)
+
+    return False
+
+
 def is_watch_user(user: User, the_type: str, now: int) -> bool:
     # Check if the message is sent by a watch user
     try:
@@ -711,7 +808,7 @@ def is_watch_user(user: User, the_type: str, now: int) -> bool:
             return False
 
         uid = user.id
-        until = glovar.watch_ids[the_type].get(uid, 0)
+        until = get_watch_until(the_type, uid)
 
         if now < until:
             return True
@@ -721,21 +818,128 @@ def is_watch_user(user: User, the_type: str, now: int) -> bool:
     return False
 
 
-def is_wb_text(text: str, ocr: bool) -> bool:
+def is_wb_text(text: str, ocr: bool, evaluation: Evaluation = None) -> bool:
     # Check if the text is wb text
     try:
-        if (is_regex_text("wb", text, ocr)
-                or is_regex_text("ad", text, ocr)
-                or is_regex_text("iml", text, ocr)
-                or is_regex_text("pho", text, ocr)
-                or is_regex_text("sho", text, ocr)
-                or is_regex_text("spc", text, ocr)):
+        if (is_regex_text("wb", text, ocr, evaluation)
+                or is_regex_text("ad", text, ocr, evaluation)
+                or is_regex_text("iml", text, ocr, evaluation)
+                or is_regex_text("pho", text, ocr, evaluation)
+                or is_regex_text("sho", text, ocr, evaluation)
+                or is_regex_text("spc", text, ocr, evaluation)):
             return True
 
-        for c in ascii_lowercase:
-            if c not in {"i"} and is_regex_text(f"ad{c}", text, ocr):
-                return True
+        if get_ad_types(text, ocr, evaluation) - {"i"}:
+            return True
     except Exception as e:
         logger.warning(f"Is wb text error: {e}", exc_info=True)
 
     return False
+
+
+def profile_rules(times: Dict[str, Dict[str, List[Union[float, int]]]]) -> bool:
+    # Add the times of the rules that a check has run, the times are swapped out by send_profile under the same lock
+    try:
+        with glovar.locks["profile"]:
+            for word_type in times:
+                if not times[word_type]:
+                    continue
+
+                records = glovar.regex_times.setdefault(word_type, {})
+
+                for word, (total, count) in times[word_type].items():
+                    record = records.setdefault(word, [0.0, 0])
+                    record[0] += total
+                    record[1] += count
+
+        return True
+    except Exception as e:
+        logger.warning(f"Profile rules error: {e}", exc_info=True)
+
+    return False
+
+
+def quarantine_rules(word_type: str, slow: List[Union[Rule, Suspect]]) -> bool:
+    # Note the slow rules, the rules that are over the time budget again and again within the window are quarantined
+    # by update_quarantine in the timer, so the message path is not blocked by the timing or the recompiling
+    try:
+        now = get_now()
+
+        for item in slow:
+            # The rules of a slow fused chunk are timed one by one later
+            if isinstance(item, Suspect):
+                len(glovar.regex_suspects) < 100 and glovar.regex_suspects.append((word_type, item))
+                continue
+
+            key = (word_type, item.word)
+            strikes = [t for t in glovar.regex_slow.get(key, []) if now - t < glovar.regex_window] + [now]
+            glovar.regex_slow[key] = strikes
+
+            if len(strikes) >= glovar.regex_strike and key not in glovar.regex_pending:
+                glovar.regex_pending.append(key)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Quarantine rules error: {e}", exc_info=True)
+
+    return False
+
+
+def update_quarantine() -> bool:
+    # Time the rules of the slow fused chunks, then quarantine the rules that are noted again and again
+    try:
+        while glovar.regex_suspects:
+            word_type, suspect = glovar.regex_suspects.pop(0)
+            slow = []
+            find_slow(suspect, glovar.regex_budget / 1000, slow)
+            slow and quarantine_rules(word_type, slow)
+
+        words = {}
+
+        while glovar.regex_pending:
+            word_type, word = glovar.regex_pending.pop(0)
+            words.setdefault(word_type, set()).add(word)
+
+        if not words:
+            return True
+
+        with glovar.locks["regex"]:
+            for word_type in words:
+                glovar.regex_quarantine.setdefault(word_type, set()).update(words[word_type])
+                update_rules(word_type)
+
+        for word_type in words:
+            for word in words[word_type]:
+                glovar.regex_slow.pop((word_type, word), 0)
+                glovar.regex_reports.append((word_type, word))
+
+        return True
+    except Exception as e:
+        logger.warning(f"Update quarantine error: {e}", exc_info=True)
+
+    return False
+
+
+def update_rules(word_type: str) -> bool:
+    # Recompile the rules of the word type, then replace the old set at once, call it with the regex lock held
+    try:
+        version = glovar.compiled_version + 1
+        quarantine = glovar.regex_quarantine.get(word_type, set())
+        words = [word for word in eval(f"glovar.{word_type}_words") if word not in quarantine]
+
+        # Build new snapshots, then publish them, the readers keep using the old ones until then
+        compiled = dict(glovar.compiled)
+        compiled[word_type] = compile_rules(words, version, glovar.regex_engine)
+
+        if word_type in glovar.compiled_ad.rules:
+            rules = {ad_type: compiled[ad_type] for ad_type in glovar.compiled_ad.rules}
+            glovar.compiled_ad = compile_sweep(rules, version)
+
+        glovar.compiled = compiled
+        glovar.compiled_version = version
+
+        return True
+    except Exception as e:
+        logger.warning(f"Update rules error: {e}", exc_info=True)
+
+    return False
@@ -65,7 +65,7 @@ def leave_group(client: Bot, gid: int) -> bool:
         glovar.configs.pop(gid, None)
         save("configs")
 
-        glovar.declared_message_ids.pop(gid, set())
+        glovar.declared_message_ids.pop(gid, None)
         glovar.recorded_ids.pop(gid, set())
 
         return True
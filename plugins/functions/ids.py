@@ -18,14 +18,183 @@
 
 import logging
 from copy import deepcopy
+from typing import Any, Optional, Union
 
 from .. import glovar
-from .file import save
+from .compact import IdRing, IdSet, UserStatus
+from .database import add_bad, clear_bad, clear_users, clear_watch, get_bad, get_user, get_watch, import_data
+from .database import init_user, remove_bad, remove_watch, reset_user, set_user, set_watch
+from .file import journal, mark_user_bucket, read_journal, save, save_thread
 
 # Enable logging
 logger = logging.getLogger(__name__)
 
 
+def add_bad_id(the_type: str, the_id: int) -> bool:
+    # Add a bad channel or user
+    try:
+        if glovar.storage == "sqlite":
+            return add_bad(the_type, the_id)
+
+        glovar.bad_ids[the_type].add(the_id)
+        save("bad_ids")
+
+        return True
+    except Exception as e:
+        logger.warning(f"Add bad id {the_id} error: {e}", exc_info=True)
+
+    return False
+
+
+def apply_user_record(record: tuple) -> bool:
+    # Apply a mutation record to the users' data, applying a record twice has the same result as once
+    try:
+        the_type, uid = record[0], record[1]
+        mark_user_bucket(uid)
+
+        if the_type == "init":
+            if glovar.user_ids.get(uid) is None:
+                glovar.user_ids[uid] = UserStatus()
+        elif the_type == "drop":
+            user_status = glovar.user_ids.get(uid)
+
+            # Only drop the user if there is still no data, it may be updated after the sweep checked it
+            if user_status and not (user_status.join or user_status.detected or any(user_status.scores)):
+                glovar.user_ids.pop(uid, None)
+        elif the_type == "expire":
+            user_status = glovar.user_ids.get(uid)
+
+            # Only expire the join time that the sweep saw, the user may join the group again in the meantime
+            if user_status and (len(record) < 4 or user_status.join.get(record[2]) == record[3]):
+                user_status.pop_join(record[2])
+        elif the_type == "reset":
+            glovar.user_ids[uid] = UserStatus()
+        elif the_type == "score":
+            glovar.user_ids.setdefault(uid, UserStatus()).set_score(record[2], record[3])
+        else:
+            key, value = record[2], record[3]
+            eval(f"glovar.user_ids.setdefault(uid, UserStatus()).set_{the_type}")(key, value)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Apply user record {record} error: {e}", exc_info=True)
+
+    return False
+
+
+def clear_bad_ids(the_type: str) -> bool:
+    # Clear the bad channels or users
+    try:
+        if glovar.storage == "sqlite":
+            return clear_bad(the_type)
+
+        if the_type == "users":
+            glovar.bad_ids[the_type] = IdSet()
+        else:
+            glovar.bad_ids[the_type] = set()
+
+        save("bad_ids")
+
+        return True
+    except Exception as e:
+        logger.warning(f"Clear bad ids error: {e}", exc_info=True)
+
+    return False
+
+
+def clear_user_ids() -> bool:
+    # Clear all users' data
+    try:
+        if glovar.storage == "sqlite":
+            return clear_users()
+
+        glovar.user_ids = {}
+        mark_user_bucket()
+        save("user_ids")
+
+        return True
+    except Exception as e:
+        logger.warning(f"Clear user ids error: {e}", exc_info=True)
+
+    return False
+
+
+def clear_watch_ids(the_type: str) -> bool:
+    # Clear the watch ban or watch delete users
+    try:
+        if glovar.storage == "sqlite":
+            return clear_watch(the_type)
+
+        glovar.watch_ids[the_type] = {}
+        save("watch_ids")
+
+        return True
+    except Exception as e:
+        logger.warning(f"Clear watch ids error: {e}", exc_info=True)
+
+    return False
+
+
+def expire_user_id(uid: int, now: int) -> bool:
+    # Remove the user's expired join status, drop the user if there is no data left
+    try:
+        user_status = glovar.user_ids.get(uid)
+
+        if not user_status:
+            return True
+
+        # The join time only matters within these periods, the detected status is kept for the score
+        ttl = max(glovar.time_new, glovar.time_short, glovar.time_track)
+        expired = sorted((t, gid) for gid, t in list(user_status.join.items()) if now - t >= ttl)
+        scored = any(user_status.scores)
+
+        # A user with score is limited only if the user has a join status, so keep the latest one
+        if scored and len(expired) == len(user_status.join):
+            expired = expired[:-1]
+
+        for t, gid in expired:
+            journal("user_ids", ("expire", uid, gid, t), apply_user_record)
+
+        if user_status.join or user_status.detected or scored:
+            return True
+
+        journal("user_ids", ("drop", uid), apply_user_record)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Expire user id {uid} error: {e}", exc_info=True)
+
+    return False
+
+
+def get_user_status(uid: int) -> Optional[UserStatus]:
+    # Get the user's status, it should only be read, None means there is no data of the user
+    result = None
+    try:
+        if glovar.storage == "sqlite":
+            return get_user(uid)
+
+        result = glovar.user_ids.get(uid)
+    except Exception as e:
+        logger.warning(f"Get user status {uid} error: {e}", exc_info=True)
+
+    return result
+
+
+def get_watch_until(the_type: str, uid: int) -> int:
+    # Get the time until which the user is watched
+    result = 0
+    try:
+        if glovar.storage == "sqlite":
+            return get_watch(the_type, uid)
+
+        result = glovar.watch_ids[the_type].get(uid, 0)
+    except Exception as e:
+        logger.warning(f"Get watch until {uid} error: {e}", exc_info=True)
+
+    return result
+
+
 def init_group_id(gid: int) -> bool:
     # Init group data
     try:
@@ -51,7 +220,7 @@ def init_group_id(gid: int) -> bool:
             save("configs")
 
         if glovar.declared_message_ids.get(gid) is None:
-            glovar.declared_message_ids[gid] = set()
+            glovar.declared_message_ids[gid] = IdRing()
 
         if glovar.recorded_ids.get(gid) is None:
             glovar.recorded_ids[gid] = set()
@@ -66,12 +235,149 @@ def init_group_id(gid: int) -> bool:
 def init_user_id(uid: int) -> bool:
     # Init user data
     try:
+        if glovar.storage == "sqlite":
+            return init_user(uid)
+
         if glovar.user_ids.get(uid) is None:
-            glovar.user_ids[uid] = deepcopy(glovar.default_user_status)
-            save("user_ids")
+            journal("user_ids", ("init", uid), apply_user_record)
 
         return True
     except Exception as e:
         logger.warning(f"Init user id {uid} error: {e}", exc_info=True)
 
     return False
+
+
+def is_bad_id(the_type: str, the_id: int) -> bool:
+    # Check if the channel or user is bad
+    try:
+        if glovar.storage == "sqlite":
+            return get_bad(the_type, the_id)
+
+        return the_id in glovar.bad_ids[the_type]
+    except Exception as e:
+        logger.warning(f"Is bad id {the_id} error: {e}", exc_info=True)
+
+    return False
+
+
+def load_ids(file: str, data: Any) -> bool:
+    # Replace the whole data of the global variable
+    try:
+        if glovar.storage == "sqlite" and file in {"bad_ids", "user_ids", "watch_ids"}:
+            return import_data(file, data)
+
+        if file == "bad_ids" and not isinstance(data.get("users"), IdSet):
+            data["users"] = IdSet(data.get("users", set()))
+        elif file == "user_ids":
+            data = {uid: UserStatus.from_dict(data[uid]) for uid in data}
+
+        exec(f"glovar.{file} = data")
+        file == "user_ids" and mark_user_bucket()
+        save(file)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Load ids {file} error: {e}", exc_info=True)
+
+    return False
+
+
+def remove_bad_id(the_type: str, the_id: int) -> bool:
+    # Remove a bad channel or user
+    try:
+        if glovar.storage == "sqlite":
+            return remove_bad(the_type, the_id)
+
+        glovar.bad_ids[the_type].discard(the_id)
+        save("bad_ids")
+
+        return True
+    except Exception as e:
+        logger.warning(f"Remove bad id {the_id} error: {e}", exc_info=True)
+
+    return False
+
+
+def remove_watch_id(uid: int) -> bool:
+    # Remove the user from the watch lists
+    try:
+        if glovar.storage == "sqlite":
+            return remove_watch(uid)
+
+        glovar.watch_ids["ban"].pop(uid, 0)
+        glovar.watch_ids["delete"].pop(uid, 0)
+        save("watch_ids")
+
+        return True
+    except Exception as e:
+        logger.warning(f"Remove watch id {uid} error: {e}", exc_info=True)
+
+    return False
+
+
+def replay_user_ids() -> int:
+    # Replay the journal on the loaded users' data, compact it if there are records
+    result = 0
+    try:
+        records = read_journal("user_ids")
+
+        for record in records:
+            apply_user_record(record)
+
+        # Compact it before the data may be moved into the database
+        result = len(records)
+        result and save_thread("user_ids")
+    except Exception as e:
+        logger.warning(f"Replay user ids error: {e}", exc_info=True)
+
+    return result
+
+
+def reset_user_id(uid: int) -> bool:
+    # Reset user data
+    try:
+        if glovar.storage == "sqlite":
+            return reset_user(uid)
+
+        journal("user_ids", ("reset", uid), apply_user_record)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Reset user id {uid} error: {e}", exc_info=True)
+
+    return False
+
+
+def set_watch_until(the_type: str, uid: int, until: int) -> bool:
+    # Set the time until which the user is watched
+    try:
+        if glovar.storage == "sqlite":
+            return set_watch(the_type, uid, until)
+
+        glovar.watch_ids[the_type][uid] = until
+        save("watch_ids")
+
+        return True
+    except Exception as e:
+        logger.warning(f"Set watch until {uid} error: {e}", exc_info=True)
+
+    return False
+
+
+def update_user_id(uid: int, the_type: str, key: Union[int, str], value: Union[float, int]) -> bool:
+    # Update the user's detected, join or score data
+    try:
+        if glovar.storage == "sqlite":
+            return set_user(uid, the_type, key, value)
+
+        if not init_user_id(uid):
+            return False
+
+        journal("user_ids", (the_type, uid, key, value), apply_user_record)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Update user id {uid} error: {e}", exc_info=True)
+
+    return False
@@ -17,8 +17,6 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-import pickle
-from copy import deepcopy
 from json import loads
 from typing import Any
 
@@ -27,9 +25,11 @@ from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, Message
 from .. import glovar
 from .channel import get_debug_text, share_data
 from .etc import code, crypt_str, general_link, get_int, get_text, lang, mention_id, thread
-from .file import crypt_file, data_to_file, delete_file, get_new_path, get_downloaded_path, save
+from .file import crypt_file, data_to_file, delete_file, get_new_path, get_downloaded_path, load_file, save
+from .filters import update_rules
 from .group import get_config_text, leave_group
-from .ids import init_group_id, init_user_id
+from .ids import add_bad_id, clear_bad_ids, clear_user_ids, clear_watch_ids, get_user_status, init_group_id, load_ids
+from .ids import remove_bad_id, remove_watch_id, reset_user_id, set_watch_until, update_user_id
 from .telegram import send_message, send_report_message
 from .timers import update_admins
 
@@ -46,13 +46,11 @@ def receive_add_bad(sender: str, data: dict) -> bool:
 
         # Receive bad channel
         if sender == "MANAGE" and the_type == "channel":
-            glovar.bad_ids["channels"].add(the_id)
+            add_bad_id("channels", the_id)
 
         # Receive bad user
         if the_type == "user":
-            glovar.bad_ids["users"].add(the_id)
-
-        save("bad_ids")
+            add_bad_id("users", the_id)
 
         return True
     except Exception as e:
@@ -91,12 +89,8 @@ def receive_clear_data(client: Bot, data_type: str, data: dict) -> bool:
 
         # Clear bad data
         if data_type == "bad":
-            if the_type == "channels":
-                glovar.bad_ids["channels"] = set()
-            elif the_type == "users":
-                glovar.bad_ids["users"] = set()
-
-            save("bad_ids")
+            if the_type in {"channels", "users"}:
+                clear_bad_ids(the_type)
 
         # Clear except data
         if data_type == "except":
@@ -108,23 +102,15 @@ def receive_clear_data(client: Bot, data_type: str, data: dict) -> bool:
         # Clear user data
         if data_type == "user":
             if the_type == "all":
-                glovar.user_ids = {}
-
-            save("user_ids")
+                clear_user_ids()
 
         # Clear watch data
         if data_type == "watch":
             if the_type == "all":
-                glovar.watch_ids = {
-                    "ban": {},
-                    "delete": {}
-                }
-            elif the_type == "ban":
-                glovar.watch_ids["ban"] = {}
-            elif the_type == "delete":
-                glovar.watch_ids["delete"] = {}
-
-            save("watch_ids")
+                clear_watch_ids("ban")
+                clear_watch_ids("delete")
+            elif the_type in {"ban", "delete"}:
+                clear_watch_ids(the_type)
 
         # Send debug message
         text = (f"{lang('project')}{lang('colon')}{general_link(glovar.project_name, glovar.project_link)}\n"
@@ -271,8 +257,7 @@ def receive_file_data(client: Bot, message: Message, decrypt: bool = True) -> An
             path_decrypted = ""
             path_final = path
 
-        with open(path_final, "rb") as f:
-            data = pickle.load(f)
+        data = load_file(path_final)
 
         for f in {path, path_decrypted}:
             thread(delete_file, (f,))
@@ -362,10 +347,22 @@ def receive_regex(client: Bot, message: Message, data: str) -> bool:
 
         save(file_name)
 
-        # Regenerate special characters dictionary if possible
+        # The quarantined rules get another chance with the new rules
+        glovar.regex_quarantine.pop(word_type, None)
+
+        for key in [key for key in list(glovar.regex_slow) if key[0] == word_type]:
+            glovar.regex_slow.pop(key, None)
+
+        glovar.regex_pending = [key for key in glovar.regex_pending if key[0] != word_type]
+        glovar.regex_suspects = [item for item in glovar.regex_suspects if item[0] != word_type]
+
+        # Recompile the rules
+        update_rules(word_type)
+
+        # Regenerate special characters dictionary and translation table if possible
         if file_name in {"spc_words", "spe_words"}:
             special = file_name.split("_")[0]
-            exec(f"glovar.{special}_dict = {{}}")
+            special_dict = {}
 
             for rule in words_data:
                 # Check keys
@@ -380,7 +377,16 @@ def receive_regex(client: Bot, message: Message, data: str) -> bool:
                 value = rule.split("?#")[1][1]
 
                 for k in keys:
-                    eval(f"glovar.{special}_dict")[k] = value
+                    special_dict[k] = value
+
+            special_table = str.maketrans(special_dict)
+            exec(f"glovar.{special}_dict = special_dict")
+            exec(f"glovar.{special}_table = special_table")
+
+            # The cached names were converted with the old table
+            glovar.locks["name"].acquire()
+            glovar.names.clear()
+            glovar.locks["name"].release()
 
         return True
     except Exception as e:
@@ -400,18 +406,13 @@ def receive_remove_bad(data: dict) -> bool:
 
         # Remove bad channel
         if the_type == "channel":
-            glovar.bad_ids["channels"].discard(the_id)
+            remove_bad_id("channels", the_id)
 
         # Remove bad user
         if the_type == "user":
-            glovar.bad_ids["users"].discard(the_id)
-            glovar.watch_ids["ban"].pop(the_id, {})
-            glovar.watch_ids["delete"].pop(the_id, {})
-            save("watch_ids")
-            glovar.user_ids[the_id] = deepcopy(glovar.default_user_status)
-            save("user_ids")
-
-        save("bad_ids")
+            remove_bad_id("users", the_id)
+            remove_watch_id(the_id)
+            reset_user_id(the_id)
 
         return True
     except Exception as e:
@@ -447,11 +448,10 @@ def receive_remove_score(data: int) -> bool:
         # Basic data
         uid = data
 
-        if not glovar.user_ids.get(uid):
+        if not get_user_status(uid):
             return True
 
-        glovar.user_ids[uid] = deepcopy(glovar.default_user_status)
-        save("user_ids")
+        reset_user_id(uid)
 
         return True
     except Exception as e:
@@ -469,9 +469,7 @@ def receive_remove_watch(data: int) -> bool:
         uid = data
 
         # Reset watch status
-        glovar.watch_ids["ban"].pop(uid, 0)
-        glovar.watch_ids["delete"].pop(uid, 0)
-        save("watch_ids")
+        remove_watch_id(uid)
 
         return True
     except Exception as e:
@@ -486,13 +484,16 @@ def receive_rollback(client: Bot, message: Message, data: dict) -> bool:
         # Basic data
         aid = data["admin_id"]
         the_type = data["type"]
+
+        if the_type not in glovar.file_list:
+            return True
+
         the_data = receive_file_data(client, message)
 
         if not the_data:
             return True
 
-        exec(f"glovar.{the_type} = the_data")
-        save(the_type)
+        load_ids(the_type, the_data)
 
         # Send debug message
         text = (f"{lang('project')}{lang('colon')}{general_link(glovar.project_name, glovar.project_link)}\n"
@@ -530,12 +531,8 @@ def receive_user_score(project: str, data: dict) -> bool:
         project = project.lower()
         uid = data["id"]
 
-        if not init_user_id(uid):
-            return True
-
         score = data["score"]
-        glovar.user_ids[uid]["score"][project] = score
-        save("user_ids")
+        update_user_id(uid, "score", project, score)
 
         return True
     except Exception as e:
@@ -559,15 +556,11 @@ def receive_watch_user(data: dict) -> bool:
         until = get_int(until)
 
         # Add to list
-        if the_type == "ban":
-            glovar.watch_ids["ban"][uid] = until
-        elif the_type == "delete":
-            glovar.watch_ids["delete"][uid] = until
+        if the_type in {"ban", "delete"}:
+            set_watch_until(the_type, uid, until)
         else:
             return False
 
-        save("watch_ids")
-
         return True
     except Exception as e:
         logger.warning(f"Receive watch user error: {e}", exc_info=True)
@@ -0,0 +1,643 @@
+# SCP-079-LONG - Control super long messages
+# Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>
+#
+# This file is part of SCP-079-LONG.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import re
+from importlib import import_module
+from random import Random
+from time import perf_counter
+from types import ModuleType
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, Match, NamedTuple, Optional, Pattern, Set, Tuple
+from typing import Union
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# The CPU time of the thread does not count the time waiting for the GIL, so a rule is not blamed for other threads
+try:
+    from time import thread_time
+except ImportError:
+    from time import perf_counter as thread_time
+
+# Enable logging
+logger = logging.getLogger(__name__)
+
+# The number of rules fused into one pattern, a hit only needs the rules of its chunk to be tried again
+CHUNK = 50
+
+# The classes that are ASCII only in RE2, the rules using them would miss the CJK or full-width text
+ASCII_CLASSES = re.compile(r"(?<!\\)(?:\\\\)*\\[bBdDsSwW]")
+
+# Comments in rules, such as (?# nocr), not every engine supports them
+COMMENT = re.compile(r"(?<!\\)\(\?#[^)]*\)")
+
+# Installed regex engines, the stdlib re is always there
+engines: Dict[str, Optional[ModuleType]] = {
+    "re": re
+}
+
+# Repeat operations, the body of a repeat with a minimum of 1 is required
+REPEATS = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, "POSSESSIVE_REPEAT", None)}
+
+# A fixed text of mixed characters, to compare the fused scan with trying the rules one by one
+SAMPLE = "".join(Random(79).choice("abcdefghijklmnopqrstuvwxyz0123456789 \n@.:/"
+                                   + "".join(chr(c) for c in range(0x4E00, 0x4E00 + 500)))
+                 for _ in range(4096))
+
+# Rules using these features depend on their own group numbers or global flags, so they can not be fused
+UNFUSABLE = re.compile(r"\\[1-9]|\(\?P[<=]|\(\?\(|\(\?[aiLmsux]+\)")
+
+
+class Automaton(NamedTuple):
+    # An Aho-Corasick automaton of the rules' literals
+    goto: List[Dict[str, int]]
+    fail: List[int]
+    out: List[Tuple[str, ...]]
+
+
+class Chunk(NamedTuple):
+    # Several rules fused into one alternation without groups, so the engine keeps its own optimizations
+    pattern: Optional[Pattern]
+    pattern_ocr: Optional[Pattern]
+    rules: Tuple["Rule", ...]
+
+
+class Rule(NamedTuple):
+    # A compiled regex rule, the index is its position in the word list, the hit goes to the first rule in the list
+    word: str
+    pattern: Pattern
+    nocr: bool
+    engine: str = "re"
+    index: int = 0
+
+
+class Rules(NamedTuple):
+    # A complete set of compiled rules of one word type, it is a snapshot that is never changed after built
+    version: int
+    rules: Tuple[Rule, ...]
+    automaton: Optional[Automaton] = None
+    indexed: Dict[str, Tuple[Rule, ...]] = {}
+    fused: Tuple[Chunk, ...] = ()
+    single: Tuple[Rule, ...] = ()
+    engine: str = "re"
+
+
+class Suspect(NamedTuple):
+    # A fused chunk that was over the time budget on the text, its rules are timed one by one later
+    chunk: Chunk
+    text: str
+    ocr: bool
+
+
+class Sweep(NamedTuple):
+    # The rules of several word types, checked together, it is a snapshot that is never changed after built
+    version: int
+    automaton: Optional[Automaton]
+    indexed: Dict[str, Tuple[Tuple[str, Rule], ...]]
+    rules: Dict[str, Rules]
+
+
+class Trie(NamedTuple):
+    # The words compiled into a trie shaped pattern
+    pattern: Pattern
+    first: FrozenSet[str]
+
+
+def compile_automaton(literals: Iterable[str]) -> Optional[Automaton]:
+    # Build an Aho-Corasick automaton
+    result = None
+    try:
+        goto = [{}]
+        fail = [0]
+        out = [set()]
+
+        for literal in literals:
+            state = 0
+
+            for char in literal:
+                if char not in goto[state]:
+                    goto.append({})
+                    fail.append(0)
+                    out.append(set())
+                    goto[state][char] = len(goto) - 1
+
+                state = goto[state][char]
+
+            out[state].add(literal)
+
+        if len(goto) == 1:
+            return None
+
+        # Breadth-first, so the fail state of a state is always done before the state itself,
+        # the states of depth 1 fail to the root
+        queue = list(goto[0].values())
+
+        for state in queue:
+            for char, next_state in goto[state].items():
+                queue.append(next_state)
+                fallback = fail[state]
+
+                while fallback and char not in goto[fallback]:
+                    fallback = fail[fallback]
+
+                fail[next_state] = goto[fallback].get(char, 0)
+                out[next_state] |= out[fail[next_state]]
+
+        result = Automaton(goto, fail, [tuple(o) for o in out])
+    except Exception as e:
+        logger.warning(f"Compile automaton error: {e}", exc_info=True)
+
+    return result
+
+
+def compile_fused(rules: Iterable[Rule], engine: str = "re") -> Optional[Pattern]:
+    # Fuse the rules into one alternation
+    result = None
+    try:
+        words = [f"(?:{rule.word})" for rule in rules]
+
+        if not words:
+            return None
+
+        module = get_engine(engine)
+
+        if module is re:
+            result = re.compile("|".join(words), re.I | re.S | re.M)
+        else:
+            result = module.compile(f"(?ims){COMMENT.sub('', '|'.join(words))}")
+    except Exception as e:
+        logger.warning(f"Compile fused error: {e}", exc_info=True)
+
+    return result
+
+
+def compile_chunks(rules: List[Rule], engine: str = "re") -> Tuple[Tuple[Chunk, ...], Tuple[Rule, ...]]:
+    # Fuse the rules in chunks, a chunk is kept only if its scan is faster than trying its rules one by one
+    chunks = []
+    single = []
+
+    for i in range(0, len(rules), CHUNK):
+        part = tuple(rules[i:i + CHUNK])
+        chunk = Chunk(compile_fused(part, engine),
+                      compile_fused([rule for rule in part if not rule.nocr], engine),
+                      part)
+
+        if (chunk.pattern and (chunk.pattern_ocr or all(rule.nocr for rule in part))
+                and get_time(lambda: chunk.pattern.search(SAMPLE))
+                < get_time(lambda: [rule.pattern.search(SAMPLE) for rule in part])):
+            chunks.append(chunk)
+        else:
+            single.extend(part)
+
+    return tuple(chunks), tuple(single)
+
+
+def compile_pattern(word: str, engine: str = "re") -> Tuple[Pattern, str]:
+    # Compile a pattern with the engine, fall back to re if the engine is missing, does not support the pattern,
+    # or treats the pattern differently
+    module = get_engine(engine)
+
+    if engine == "re2" and ASCII_CLASSES.search(word):
+        module = None
+
+    if module and module is not re:
+        try:
+            return module.compile(f"(?ims){COMMENT.sub('', word)}"), engine
+        except Exception as e:
+            logger.info(f"Compile pattern {word} with {engine} error: {e}")
+
+    return re.compile(word, re.I | re.S | re.M), "re"
+
+
+def compile_rule(word: str, engine: str = "re", index: int = 0) -> Rule:
+    # Compile a regex rule
+    result = None
+    try:
+        pattern, engine = compile_pattern(word, engine)
+        result = Rule(word, pattern, "(?# nocr)" in word, engine, index)
+    except Exception as e:
+        logger.warning(f"Compile rule {word} error: {e}")
+
+    return result
+
+
+def compile_rules(words: Iterable[str], version: int = 0, engine: str = "re") -> Rules:
+    # Compile the rules of one word type
+    result = Rules(version, ())
+    try:
+        if not get_engine(engine):
+            engine = "re"
+
+        rules = tuple(rule for rule in (compile_rule(word, engine, i) for i, word in enumerate(words)) if rule)
+
+        # Index the rules that have a required literal
+        indexed = {}
+
+        for rule in rules:
+            literal = get_literal(rule.word)
+            literal and indexed.setdefault(literal, []).append(rule)
+
+        indexed = {literal: tuple(indexed[literal]) for literal in indexed}
+        automaton = compile_automaton(indexed)
+        indexed_rules = [rule for literal in indexed for rule in indexed[literal]]
+
+        # The automaton walks every character in Python, so it is only kept if it is faster than trying the rules
+        if automaton and (get_time(lambda: [rule.pattern.search(SAMPLE)
+                                            for literal in search_automaton(automaton, SAMPLE.lower())
+                                            for rule in indexed[literal]])
+                          >= get_time(lambda: [rule.pattern.search(SAMPLE) for rule in indexed_rules])):
+            automaton = None
+
+        if not automaton:
+            indexed = {}
+
+        # Fuse the other rules that the engine supports
+        indexed_words = {rule.word for literal in indexed for rule in indexed[literal]}
+        rest = [rule for rule in rules if rule.word not in indexed_words]
+        fusable = [rule for rule in rest if rule.engine == engine and not UNFUSABLE.search(rule.word)]
+        fused, unfused = compile_chunks(fusable, engine)
+        single = tuple(rule for rule in rest if rule in unfused or rule not in fusable)
+
+        result = Rules(version, rules, automaton, indexed, fused, single, engine)
+    except Exception as e:
+        logger.warning(f"Compile rules error: {e}", exc_info=True)
+
+    return result
+
+
+def compile_sweep(rules: Dict[str, Rules], version: int = 0) -> Sweep:
+    # Combine the compiled rules of several word types
+    result = Sweep(version, None, {}, rules)
+    try:
+        indexed = {}
+
+        for word_type in rules:
+            for literal in rules[word_type].indexed:
+                for rule in rules[word_type].indexed[literal]:
+                    indexed.setdefault(literal, []).append((word_type, rule))
+
+        indexed = {literal: tuple(indexed[literal]) for literal in indexed}
+        automaton = compile_automaton(indexed)
+        result = Sweep(version, automaton, indexed if automaton else {}, rules)
+    except Exception as e:
+        logger.warning(f"Compile sweep error: {e}", exc_info=True)
+
+    return result
+
+
+def compile_trie(words: Iterable[str]) -> Optional[Trie]:
+    # Compile the words into one pattern shaped like a trie, it matches the longest word at each position
+    result = None
+    try:
+        root = {}
+
+        for word in words:
+            node = root
+
+            for char in word:
+                node = node.setdefault(char, {})
+
+            node[""] = {}
+
+        if not root:
+            return None
+
+        result = Trie(re.compile(get_trie(root)), frozenset(root))
+    except Exception as e:
+        logger.warning(f"Compile trie error: {e}", exc_info=True)
+
+    return result
+
+
+def find_slow(suspect: Suspect, budget: float, slow: List[Rule]) -> bool:
+    # The fused pattern is over the budget, time its rules one by one to find the slow ones
+    for rule in suspect.chunk.rules:
+        if suspect.ocr and rule.nocr:
+            continue
+
+        search_rule(rule, suspect.text, budget, slow)
+
+    return True
+
+
+def get_engine(name: str) -> Optional[ModuleType]:
+    # Get an installed regex engine
+    if name not in engines:
+        try:
+            engines[name] = import_module(name)
+        except ImportError:
+            logger.warning(f"Regex engine {name} is not installed, use re instead")
+            engines[name] = None
+
+    return engines[name]
+
+
+def get_literal(word: str) -> str:
+    # Get the longest literal that every match of the rule contains, in lower case
+    result = ""
+    try:
+        runs = []
+        get_runs(sre_parse.parse(word, re.I | re.S | re.M), runs, [])
+
+        # Characters with special case folding can not be found by lowering the text
+        for run in runs:
+            part = ""
+
+            for char in run.lower() + "i":
+                if is_caseless(char):
+                    part += char
+                    continue
+
+                if len(part) > len(result):
+                    result = part
+
+                part = ""
+    except Exception as e:
+        logger.info(f"Get literal {word} error: {e}")
+
+    return result
+
+
+def get_runs(p: Iterable, runs: List[str], current: List[str]) -> bool:
+    # Collect the runs of literal characters that must appear
+    for op, av in p:
+        if op is sre_parse.LITERAL:
+            current.append(chr(av))
+        elif op is sre_parse.SUBPATTERN:
+            get_runs(av[-1], runs, current)
+        elif op is getattr(sre_parse, "ATOMIC_GROUP", None):
+            get_runs(av, runs, current)
+        elif op in REPEATS and av[0] >= 1:
+            runs.append("".join(current))
+            current.clear()
+            inner = []
+            get_runs(av[2], runs, inner)
+            runs.append("".join(inner))
+        else:
+            runs.append("".join(current))
+            current.clear()
+
+    runs.append("".join(current))
+    current.clear()
+
+    return True
+
+
+def get_time(function: Callable[[], Any]) -> float:
+    # Get the shortest run time of the function in several runs
+    result = float("inf")
+
+    for _ in range(3):
+        start = perf_counter()
+        function()
+        result = min(result, perf_counter() - start)
+
+    return result
+
+
+def get_trie(node: dict) -> str:
+    # Get the pattern of a trie node, the longer words are tried first
+    branches = [re.escape(char) + get_trie(node[char]) for char in sorted(node) if char]
+
+    if not branches:
+        return ""
+
+    result = (len(branches) == 1 and branches[0]) or f"(?:{'|'.join(branches)})"
+
+    if "" in node:
+        result = f"(?:{result})?"
+
+    return result
+
+
+def is_caseless(char: str) -> bool:
+    # Check if the lower case char is always found by lowering the text in IGNORECASE mode
+    if ord(char) < 128:
+        return char not in {"i", "s"}
+
+    return char.lower() == char.upper() == char
+
+
+def match_candidates(rules: Iterable[Rule], text: str, ocr: bool = False, budget: float = 0.0,
+                     slow: List[Rule] = None,
+                     times: Dict[str, List[Union[float, int]]] = None) -> Optional[Tuple[Rule, Match]]:
+    # Try the rules in the list order, get the first one that matches
+    for rule in sorted(rules, key=lambda r: r.index):
+        if ocr and rule.nocr:
+            continue
+
+        result = search_rule(rule, text, budget, slow, times)
+
+        if result:
+            return rule, result
+
+    return None
+
+
+def match_rest(rules: Rules, text: str, ocr: bool = False, budget: float = 0.0,
+               slow: List[Union[Rule, Suspect]] = None, best: Optional[Tuple[Rule, Match]] = None,
+               times: Dict[str, List[Union[float, int]]] = None) -> Optional[Tuple[Rule, Match]]:
+    # Scan the text with the fused chunks and the other rules, only the rules before the best hit so far are tried
+    limit = best[0].index if best else float("inf")
+
+    # The chunks are in the list order, so the rules of the later chunks are all after a hit in a chunk
+    for chunk in rules.fused:
+        if chunk.rules[0].index >= limit:
+            break
+
+        # A profiled check runs the rules of the chunk one by one, so every rule gets its own time
+        if times is not None:
+            hit = match_candidates([rule for rule in chunk.rules if rule.index < limit], text, ocr,
+                                   budget, slow, times)
+
+            if hit:
+                best, limit = hit, hit[0].index
+                break
+
+            continue
+
+        fused = chunk.pattern_ocr if ocr else chunk.pattern
+
+        if not fused:
+            continue
+
+        start = thread_time()
+
+        try:
+            result = search_pattern(fused, rules.engine, text, budget)
+        except TimeoutError:
+            result = None
+
+        # Timing the rules of the chunk again would stall the message path, so only note the chunk
+        if budget and slow is not None and thread_time() - start > budget:
+            slow.append(Suspect(chunk, text, ocr))
+
+        if not result:
+            continue
+
+        hit = match_candidates([rule for rule in chunk.rules if rule.index < limit], text, ocr)
+
+        if hit:
+            best, limit = hit, hit[0].index
+            break
+
+    for rule in rules.single:
+        if rule.index >= limit:
+            break
+
+        if ocr and rule.nocr:
+            continue
+
+        result = search_rule(rule, text, budget, slow, times)
+
+        if result:
+            return rule, result
+
+    return best
+
+
+def match_rules(rules: Rules, text: str, ocr: bool = False, budget: float = 0.0,
+                slow: List[Union[Rule, Suspect]] = None,
+                times: Dict[str, List[Union[float, int]]] = None) -> Optional[Tuple[Rule, Match]]:
+    # Only run the rules whose literal is in the text, then scan the other rules before the first hit
+    best = None
+
+    if rules.automaton:
+        candidates = {}
+
+        for literal in search_automaton(rules.automaton, text.lower()):
+            for rule in rules.indexed[literal]:
+                candidates[rule.word] = rule
+
+        best = match_candidates(candidates.values(), text, ocr, budget, slow, times)
+
+    return match_rest(rules, text, ocr, budget, slow, best, times)
+
+
+def search_automaton(automaton: Automaton, text: str) -> Set[str]:
+    # Get the literals in the text
+    result = set()
+    goto, fail, out = automaton
+    state = 0
+
+    for char in text:
+        while state and char not in goto[state]:
+            state = fail[state]
+
+        state = goto[state].get(char, 0)
+
+        if out[state]:
+            result.update(out[state])
+
+    return result
+
+
+def search_pattern(pattern: Pattern, engine: str, text: str, budget: float = 0.0) -> Optional[Match]:
+    # Search the text, the regex engine gives up with TimeoutError when the search is over the budget
+    if budget and engine == "regex":
+        return pattern.search(text, timeout=budget)
+
+    return pattern.search(text)
+
+
+def search_rule(rule: Rule, text: str, budget: float = 0.0, slow: List[Rule] = None,
+                times: Dict[str, List[Union[float, int]]] = None) -> Optional[Match]:
+    # Search the text with the rule, note the rule if it is over the time budget, add the time if it is profiled
+    if (not budget or slow is None) and times is None:
+        return rule.pattern.search(text)
+
+    start = thread_time()
+
+    try:
+        result = search_pattern(rule.pattern, rule.engine, text, budget if slow is not None else 0.0)
+    except TimeoutError:
+        result = None
+
+    elapsed = thread_time() - start
+
+    if budget and slow is not None and elapsed > budget:
+        slow.append(rule)
+
+    if times is not None:
+        record = times.setdefault(rule.word, [0.0, 0])
+        record[0] += elapsed
+        record[1] += 1
+
+    return result
+
+
+def search_trie(trie: Trie, text: str) -> List[str]:
+    # Find the longest words in the text from left to right
+    result = []
+    try:
+        # A charset of thousands of non-BMP characters is slow in re, so only the characters in the text are used
+        chars = trie.first.intersection(text)
+
+        if not chars:
+            return []
+
+        candidate = re.compile(f"[{''.join(re.escape(char) for char in sorted(chars))}]")
+        position = 0
+
+        while True:
+            start = candidate.search(text, position)
+
+            if not start:
+                break
+
+            match = trie.pattern.match(text, start.start())
+
+            if match:
+                result.append(match.group())
+                position = match.end()
+            else:
+                position = start.end()
+    except Exception as e:
+        logger.warning(f"Search trie error: {e}", exc_info=True)
+
+    return result
+
+
+def sweep_rules(sweep: Sweep, text: str, ocr: bool = False,
+                budget: float = 0.0, slow: Dict[str, List[Union[Rule, Suspect]]] = None,
+                times: Dict[str, Dict[str, List[Union[float, int]]]] = None) -> Dict[str, Tuple[Rule, Match]]:
+    # Get every word type that the text hits, the literals of all types are searched in one pass
+    result = {}
+    candidates = {}
+
+    if slow is None:
+        slow = {}
+        budget = 0.0
+
+    if sweep.automaton:
+        for literal in search_automaton(sweep.automaton, text.lower()):
+            for word_type, rule in sweep.indexed[literal]:
+                candidates.setdefault(word_type, {})[rule.word] = rule
+
+    for word_type in sweep.rules:
+        type_times = times.setdefault(word_type, {}) if times is not None else None
+        best = match_candidates(candidates.get(word_type, {}).values(), text, ocr,
+                                budget, slow.setdefault(word_type, []), type_times)
+        hit = match_rest(sweep.rules[word_type], text, ocr, budget, slow[word_type], best, type_times)
+
+        if hit:
+            result[word_type] = hit
+
+    return result
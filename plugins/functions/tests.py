@@ -22,7 +22,7 @@ import re
 from telegram import Bot, Message
 
 from .. import glovar
-from .etc import code, get_text, lang, thread, mention_id
+from .etc import MessageView, code, lang, thread, mention_id
 from .telegram import send_message
 
 # Enable logging
@@ -32,26 +32,27 @@ logger = logging.getLogger(__name__)
 def long_test(client: Bot, message: Message) -> bool:
     # Test message's length
     try:
-        origin_text = get_text(message)
+        view = MessageView(message)
+        origin_text = view.text
 
         if re.search(f"^{lang('admin')}{lang('colon')}[0-9]", origin_text):
             return True
         else:
             aid = message.from_user.id
 
-        message_text = get_text(message)
+        message_text = view.text
 
         if not message_text:
             return True
 
-        # Get length
-        length = len(message_text.encode())
+        # Check length
+        if view.below(1500):
+            return True
 
         # Send the result
-        if length >= 1500:
-            text = (f"{lang('admin')}{lang('colon')}{mention_id(aid)}\n\n"
-                    f"{lang('message_length')}{lang('colon')}{code(length)}\n")
-            thread(send_message, (client, glovar.test_group_id, text, message.message_id))
+        text = (f"{lang('admin')}{lang('colon')}{mention_id(aid)}\n\n"
+                f"{lang('message_length')}{lang('colon')}{code(view.length)}\n")
+        thread(send_message, (client, glovar.test_group_id, text, message.message_id))
 
         return True
     except Exception as e:
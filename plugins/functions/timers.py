@@ -17,15 +17,19 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-from time import sleep
+from time import perf_counter, sleep
 
 from telegram import Bot
 
 from .. import glovar
-from .channel import share_data, share_regex_count
-from .etc import code, general_link, lang, thread
-from .file import save
+from .channel import share_data, share_regex_count, share_regex_profile
+from .compact import UserStatus
+from .etc import code, general_link, get_now, lang, thread
+from .database import expire_users, export_data, get_uids
+from .file import compress_file, data_to_file, save, save_dirty
+from .filters import update_quarantine
 from .group import leave_group
+from .ids import clear_bad_ids, clear_user_ids, clear_watch_ids, expire_user_id
 from .telegram import get_admins, get_chat_member, get_group_info, send_message
 
 # Enable logging
@@ -35,11 +39,38 @@ logger = logging.getLogger(__name__)
 def backup_files(client: Bot) -> bool:
     # Backup data files to BACKUP
     try:
+        with glovar.locks["regex"]:
+            merge_count()
+
+        save_dirty()
+
         for file in glovar.file_list:
+            # Export the data stored in the database
+            if glovar.storage == "sqlite" and file in {"bad_ids", "user_ids", "watch_ids"}:
+                data = export_data(file)
+            else:
+                data = eval(f"glovar.{file}")
+
+            # Share the users' data as dicts and the bad ids as sets, so the backup can be restored by the old versions
+            if file == "bad_ids":
+                data = {the_type: set(data[the_type]) for the_type in data}
+            elif file == "user_ids":
+                data = {uid: UserStatus.from_dict(status).to_dict() for uid, status in list(data.items())}
+
             # Check
-            if not eval(f"glovar.{file}"):
+            if not data:
                 continue
 
+            # The database, the bad ids and the users' data buckets are shared as a single pickled file
+            if (glovar.storage == "sqlite" and file == "watch_ids") or file in {"bad_ids", "user_ids"}:
+                file_path = data_to_file(data)
+            else:
+                file_path = f"data/{file}"
+
+            # Compress the file before it is encrypted, the rollback reads the old uncompressed files as well
+            if glovar.backup_compress:
+                file_path = compress_file(file_path)
+
             # Share
             share_data(
                 client=client,
@@ -47,7 +78,7 @@ def backup_files(client: Bot) -> bool:
                 action="backup",
                 action_type="data",
                 data=file,
-                file=f"data/{file}"
+                file=file_path
             )
             sleep(5)
 
@@ -58,6 +89,29 @@ def backup_files(client: Bot) -> bool:
     return False
 
 
+def interval_min_1(client: Bot) -> bool:
+    # Execute every minute
+    try:
+        # Quarantine the slow regex rules
+        update_quarantine()
+
+        # Report quarantined regex rules
+        while glovar.regex_reports:
+            word_type, word = glovar.regex_reports.pop(0)
+            text = (f"{lang('project')}{lang('colon')}{general_link(glovar.project_name, glovar.project_link)}\n"
+                    f"{lang('action')}{lang('colon')}{code(lang('regex_quarantine'))}\n"
+                    f"{lang('regex_type')}{lang('colon')}{code(f'{word_type}_words')}\n"
+                    f"{lang('rule')}{lang('colon')}{code(word)}\n"
+                    f"{lang('regex_budget')}{lang('colon')}{code(f'{glovar.regex_budget} ms')}\n")
+            thread(send_message, (client, glovar.debug_channel_id, text))
+
+        return True
+    except Exception as e:
+        logger.warning(f"Interval min 1 error: {e}", exc_info=True)
+
+    return False
+
+
 def interval_min_10() -> bool:
     # Execute every 10 minutes
     glovar.locks["message"].acquire()
@@ -66,6 +120,17 @@ def interval_min_10() -> bool:
         for gid in list(glovar.recorded_ids):
             glovar.recorded_ids[gid] = set()
 
+        # Save regex count
+        save("regex_counts")
+
+        # Log the name cache stats, the logger only shows warnings
+        with glovar.locks["name"]:
+            hit, miss = glovar.names_stats["hit"], glovar.names_stats["miss"]
+            glovar.names_stats["hit"], glovar.names_stats["miss"] = 0, 0
+            size = len(glovar.names)
+
+        logger.warning(f"Name cache: {hit} hits, {miss} misses, {size} names")
+
         return True
     except Exception as e:
         logger.warning(f"Interval min 10 error: {e}", exc_info=True)
@@ -75,20 +140,42 @@ def interval_min_10() -> bool:
     return False
 
 
-def reset_data(client: Bot) -> bool:
-    # Reset user data every month
+def merge_count() -> bool:
+    # Merge the regex count into the word dictionaries
     try:
-        glovar.bad_ids["users"] = set()
-        save("bad_ids")
+        for word_type in list(glovar.regex_counts):
+            # Swap the counts under the lock of counting, so no hit is counted into the old dict after it is merged
+            with glovar.locks["count"]:
+                counts = glovar.regex_counts[word_type]
+                glovar.regex_counts[word_type] = {}
+
+            if not counts:
+                continue
+
+            words = eval(f"glovar.{word_type}_words")
+
+            for word in counts:
+                if word in words:
+                    words[word] = words[word] + counts[word]
+
+            save(f"{word_type}_words")
+
+        save("regex_counts")
+
+        return True
+    except Exception as e:
+        logger.warning(f"Merge count error: {e}", exc_info=True)
+
+    return False
 
-        glovar.user_ids = {}
-        save("user_ids")
 
-        glovar.watch_ids = {
-            "ban": {},
-            "delete": {}
-        }
-        save("watch_ids")
+def reset_data(client: Bot) -> bool:
+    # Reset user data every month
+    try:
+        clear_bad_ids("users")
+        clear_user_ids()
+        clear_watch_ids("ban")
+        clear_watch_ids("delete")
 
         # Send debug message
         text = (f"{lang('project')}{lang('colon')}{general_link(glovar.project_name, glovar.project_link)}\n"
@@ -106,6 +193,8 @@ def send_count(client: Bot) -> bool:
     # Send regex count to REGEX
     glovar.locks["regex"].acquire()
     try:
+        merge_count()
+
         for word_type in glovar.regex:
             share_regex_count(client, word_type)
             word_list = list(eval(f"glovar.{word_type}_words"))
@@ -124,6 +213,70 @@ def send_count(client: Bot) -> bool:
     return False
 
 
+def send_profile(client: Bot) -> bool:
+    # Send the slowest regex rules to REGEX
+    try:
+        if not glovar.regex_profile:
+            return True
+
+        with glovar.locks["profile"]:
+            times = glovar.regex_times
+            glovar.regex_times = {}
+        data = {}
+
+        for word_type in times:
+            records = [(word, total, count, total / count) for word, (total, count) in times[word_type].items()
+                       if count]
+            records.sort(key=lambda r: r[1], reverse=True)
+            records and data.update({f"{word_type}_words": records[:100]})
+
+        share_regex_profile(client, data)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Send profile error: {e}", exc_info=True)
+
+    return False
+
+
+def sweep_users() -> bool:
+    # Remove the expired join status and the users with no data, in small slices
+    try:
+        now = get_now()
+
+        if glovar.storage == "sqlite":
+            before = now - max(glovar.time_new, glovar.time_short, glovar.time_track)
+            uids = get_uids(-2 ** 63, 1000)
+
+            # Do not hold the database lock for long
+            while uids:
+                expire_users(before, uids[0], uids[-1])
+                sleep(0.1)
+                uids = get_uids(uids[-1], 1000)
+
+            return True
+
+        uids = list(glovar.user_ids)
+        i = 0
+
+        while i < len(uids):
+            # Do not hold the message lock for long, a slice stops after 20 ms however many users are left
+            with glovar.locks["message"]:
+                start = perf_counter()
+
+                while i < len(uids) and perf_counter() - start < 0.02:
+                    expire_user_id(uids[i], now)
+                    i += 1
+
+            sleep(0.1)
+
+        return True
+    except Exception as e:
+        logger.warning(f"Sweep users error: {e}", exc_info=True)
+
+    return False
+
+
 def update_admins(client: Bot) -> bool:
     # Update admin list every day
     glovar.locks["admin"].acquire()
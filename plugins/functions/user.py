@@ -21,13 +21,12 @@ import logging
 from telegram import Bot, ChatPermissions, Message
 
 from .. import glovar
-from .etc import crypt_str, get_forward_name, get_full_name, get_now, lang, thread
+from .etc import MessageView, crypt_str, get_now, lang, thread
 from .channel import ask_for_help, declare_message, forward_evidence, send_debug, share_bad_user
 from .channel import share_watch_user, update_score
-from .file import save
-from .filters import is_class_d, is_declared_message, is_detected_user, is_high_score_user, is_limited_user, is_new_user
-from .filters import is_watch_user, is_wb_text
-from .ids import init_user_id
+from .filters import Evaluation, is_class_d, is_declared_message, is_detected_user, is_high_score_user
+from .filters import is_limited_user, is_new_user, is_watch_user, is_wb_text
+from .ids import add_bad_id, get_user_status, init_user_id, is_bad_id, set_watch_until, update_user_id
 from .telegram import delete_message, kick_chat_member, restrict_chat_member
 
 # Enable logging
@@ -37,11 +36,10 @@ logger = logging.getLogger(__name__)
 def add_bad_user(client: Bot, uid: int) -> bool:
     # Add a bad user, share it
     try:
-        if uid in glovar.bad_ids["users"]:
+        if is_bad_id("users", uid):
             return True
 
-        glovar.bad_ids["users"].add(uid)
-        save("bad_ids")
+        add_bad_id("users", uid)
         share_bad_user(client, uid)
 
         return True
@@ -57,8 +55,8 @@ def add_detected_user(gid: int, uid: int, now: int) -> bool:
         if not init_user_id(uid):
             return False
 
-        previous = glovar.user_ids[uid]["detected"].get(gid)
-        glovar.user_ids[uid]["detected"][gid] = now
+        previous = get_user_status(uid).detected.get(gid)
+        update_user_id(uid, "detected", gid, now)
 
         return bool(previous)
     except Exception as e:
@@ -71,11 +69,10 @@ def add_watch_user(client: Bot, the_type: str, uid: int, now: int) -> bool:
     # Add a watch ban user, share it
     try:
         until = now + glovar.time_ban
-        glovar.watch_ids[the_type][uid] = until
+        set_watch_until(the_type, uid, until)
         until = str(until)
         until = crypt_str("encrypt", until, glovar.key)
         share_watch_user(client, the_type, uid, until)
-        save("watch_ids")
 
         return True
     except Exception as e:
@@ -99,7 +96,8 @@ def ban_user(client: Bot, gid: int, uid: int) -> bool:
     return False
 
 
-def terminate_user(client: Bot, message: Message, length: int) -> bool:
+def terminate_user(client: Bot, message: Message, length: int,
+                   evaluation: Evaluation = None, view: MessageView = None) -> bool:
     # Delete user's message, or ban the user
     try:
         result = None
@@ -113,10 +111,12 @@ def terminate_user(client: Bot, message: Message, length: int) -> bool:
         mid = message.message_id
         now = int(message.date.strftime("%s")) or get_now()
 
-        full_name = get_full_name(message.from_user, True, True)
-        forward_name = get_forward_name(message, True, True)
+        view = view or MessageView(message)
+        full_name = view.name
+        forward_name = view.forward_name
 
-        if (is_wb_text(full_name, False) or is_wb_text(forward_name, False)) and length != 79:
+        if ((is_wb_text(full_name, False, evaluation) or is_wb_text(forward_name, False, evaluation))
+                and length != 79):
             result = forward_evidence(
                 client=client,
                 message=message,
@@ -19,17 +19,23 @@
 import logging
 import pickle
 from codecs import getdecoder
+from collections import OrderedDict
 from configparser import RawConfigParser
 from os import mkdir
 from os.path import exists
 from shutil import rmtree
+from sqlite3 import Connection
 from string import ascii_lowercase
 from threading import Lock
-from typing import Dict, List, Set, Union
+from typing import Dict, List, Optional, Set, Tuple, Union
 
 from emoji import UNICODE_EMOJI
+from opencc import OpenCC
 from telegram import Chat
 
+from .functions.compact import IdRing, IdSet, UserStatus
+from .functions.rules import Rules, Suspect, Sweep, Trie, compile_rules, compile_sweep, compile_trie
+
 # Enable logging
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -77,14 +83,24 @@ test_group_id: int = 0
 
 # [custom]
 backup: Union[bool, str] = ""
+backup_compress: Union[bool, str] = "True"
+bucket_count: int = 64
 date_reset: str = ""
 default_group_link: str = ""
 limit_track: int = 0
+name_cache: int = 1000
 project_link: str = ""
 project_name: str = ""
+regex_budget: int = 100
+regex_engine: str = "re"
+regex_profile: int = 0
+regex_strike: int = 3
+regex_window: int = 600
+storage: str = "pickle"
 time_ban: int = 0
 time_new: int = 0
 time_punish: int = 0
+time_save: int = 5
 time_short: int = 0
 time_track: int = 0
 zh_cn: Union[bool, str] = ""
@@ -141,14 +157,25 @@ try:
     # [custom]
     backup = config["custom"].get("backup", backup)
     backup = eval(backup)
+    backup_compress = config["custom"].get("backup_compress", backup_compress)
+    backup_compress = eval(backup_compress)
+    bucket_count = int(config["custom"].get("bucket_count", str(bucket_count)))
     date_reset = config["custom"].get("date_reset", date_reset)
     default_group_link = config["custom"].get("default_group_link", default_group_link)
     limit_track = int(config["custom"].get("limit_track", str(limit_track)))
+    name_cache = int(config["custom"].get("name_cache", str(name_cache)))
     project_link = config["custom"].get("project_link", project_link)
     project_name = config["custom"].get("project_name", project_name)
+    regex_budget = int(config["custom"].get("regex_budget", str(regex_budget)))
+    regex_engine = config["custom"].get("regex_engine", regex_engine)
+    regex_profile = int(config["custom"].get("regex_profile", str(regex_profile)))
+    regex_strike = int(config["custom"].get("regex_strike", str(regex_strike)))
+    regex_window = int(config["custom"].get("regex_window", str(regex_window)))
+    storage = config["custom"].get("storage", storage)
     time_ban = int(config["custom"].get("time_ban", str(time_ban)))
     time_new = int(config["custom"].get("time_new", str(time_new)))
     time_punish = int(config["custom"].get("time_punish", str(time_punish)))
+    time_save = int(config["custom"].get("time_save", str(time_save)))
     time_short = int(config["custom"].get("time_short", str(time_short)))
     time_track = int(config["custom"].get("time_track", str(time_track)))
     zh_cn = config["custom"].get("zh_cn", zh_cn)
@@ -195,14 +222,24 @@ if (enabled not in {False, True}
         or logging_channel_id == 0
         or test_group_id == 0
         or backup not in {False, True}
+        or backup_compress not in {False, True}
+        or bucket_count <= 0
         or date_reset in {"", "[DATA EXPUNGED]"}
         or default_group_link in {"", "[DATA EXPUNGED]"}
         or limit_track == 0
+        or name_cache <= 0
         or project_link in {"", "[DATA EXPUNGED]"}
         or project_name in {"", "[DATA EXPUNGED]"}
+        or regex_budget <= 0
+        or regex_engine not in {"re", "re2", "regex"}
+        or regex_profile < 0
+        or regex_strike <= 0
+        or regex_window <= 0
+        or storage not in {"pickle", "sqlite"}
         or time_ban == 0
         or time_new == 0
         or time_punish == 0
+        or time_save <= 0
         or time_short == 0
         or time_track == 0
         or zh_cn not in {False, True}
@@ -293,6 +330,10 @@ lang: Dict[str, str] = {
     # Message Types
     "gam": (zh_cn and "游戏") or "Game",
     "ser": (zh_cn and "服务消息") or "Service",
+    # Quarantine
+    "regex_quarantine": (zh_cn and "隔离超时规则") or "Quarantine Slow Rule",
+    "regex_type": (zh_cn and "规则类别") or "Rule Type",
+    "regex_budget": (zh_cn and "单次耗时上限") or "Time Budget",
     # Record
     "project": (zh_cn and "项目编号") or "Project",
     "project_origin": (zh_cn and "原始项目") or "Original Project",
@@ -344,14 +385,30 @@ all_commands: List[str] = [
 bot_ids: Set[int] = {avatar_id, captcha_id, clean_id, lang_id, long_id, noflood_id,
                      noporn_id, nospam_id, recheck_id, tip_id, user_id, warn_id}
 
+cached: OrderedDict = OrderedDict()
+# cached = {
+#     ("bad", "users", 12345678): True
+# }
+
+cached_generation: int = 0
+
 chats: Dict[int, Chat] = {}
 # chats = {
 #     -10012345678: Chat
 # }
 
-declared_message_ids: Dict[int, Set[int]] = {}
+converted: OrderedDict = OrderedDict()
+# converted = {
+#     "繁體": "繁体"
+# }
+
+converter: OpenCC = OpenCC("t2s.json")
+
+database: Optional[Connection] = None
+
+declared_message_ids: Dict[int, IdRing] = {}
 # declared_message_ids = {
-#     -10012345678: {123}
+#     -10012345678: IdRing([123])
 # }
 
 default_config: Dict[str, Union[bool, int]] = {
@@ -362,31 +419,35 @@ default_config: Dict[str, Union[bool, int]] = {
     "limit": 9000
 }
 
-default_user_status: Dict[str, Dict[Union[int, str], Union[float, int]]] = {
-    "detected": {},
-    "join": {},
-    "score": {
-        "captcha": 0.0,
-        "clean": 0.0,
-        "lang": 0.0,
-        "long": 0.0,
-        "noflood": 0.0,
-        "noporn": 0.0,
-        "nospam": 0.0,
-        "recheck": 0.0,
-        "warn": 0.0
-    }
-}
+dirty: Set[str] = set()
+# dirty = {"user_ids"}
+
+dirty_buckets: Set[int] = set()
+# dirty_buckets = {0}
 
 emoji_set: Set[str] = set(UNICODE_EMOJI)
 
+emoji_trie: Trie = compile_trie(emoji_set)
+
+journal_counts: Dict[str, int] = {}
+# journal_counts = {
+#     "user_ids": 1
+# }
+
 left_group_ids: Set[int] = set()
 
 locks: Dict[str, Lock] = {
     "admin": Lock(),
+    "convert": Lock(),
+    "count": Lock(),
+    "database": Lock(),
+    "journal": Lock(),
     "message": Lock(),
+    "name": Lock(),
+    "profile": Lock(),
     "receive": Lock(),
     "regex": Lock(),
+    "save": Lock(),
     "test": Lock()
 }
 
@@ -401,11 +462,55 @@ receivers: Dict[str, List[str]] = {
               "NOFLOOD", "NOPORN", "NOSPAM", "RECHECK", "TIP", "USER", "WARN", "WATCH"]
 }
 
+names: OrderedDict = OrderedDict()
+# names = {
+#     ("Name", True, True): "name"
+# }
+
+names_stats: Dict[str, int] = {
+    "hit": 0,
+    "miss": 0
+}
+
 recorded_ids: Dict[int, Set[int]] = {}
 # recorded_ids = {
 #     -10012345678: {12345678}
 # }
 
+regex_quarantine: Dict[str, Set[str]] = {}
+# regex_quarantine = {
+#     "ad": {"regex"}
+# }
+
+regex_pending: List[Tuple[str, str]] = []
+# regex_pending = [
+#     ("ad", "regex")
+# ]
+
+regex_reports: List[Tuple[str, str]] = []
+# regex_reports = [
+#     ("ad", "regex")
+# ]
+
+regex_sample: int = 0
+
+regex_slow: Dict[Tuple[str, str], List[int]] = {}
+# regex_slow = {
+#     ("ad", "regex"): [1512345678]
+# }
+
+regex_suspects: List[Tuple[str, Suspect]] = []
+# regex_suspects = [
+#     ("ad", Suspect(chunk=Chunk(...), text="text", ocr=False))
+# ]
+
+regex_times: Dict[str, Dict[str, List[Union[float, int]]]] = {}
+# regex_times = {
+#     "ad": {
+#         "regex": [0.5, 100]
+#     }
+# }
+
 regex: Dict[str, bool] = {
     "ad": False,
     "ban": False,
@@ -449,13 +554,13 @@ admin_ids: Dict[int, Set[int]] = {}
 #     -10012345678: {12345678}
 # }
 
-bad_ids: Dict[str, Set[Union[int, str]]] = {
+bad_ids: Dict[str, Union[IdSet, Set[int]]] = {
     "channels": set(),
-    "users": set()
+    "users": IdSet()
 }
 # bad_ids = {
 #     "channels": {-10012345678},
-#     "users": {12345678}
+#     "users": IdSet([12345678])
 # }
 
 except_ids: Dict[str, Set[int]] = {
@@ -470,27 +575,17 @@ trust_ids: Dict[int, Set[int]] = {}
 #     -10012345678: {12345678}
 # }
 
-user_ids: Dict[int, Dict[str, Dict[Union[int, str], Union[float, int]]]] = {}
+user_ids: Dict[int, UserStatus] = {}
 # user_ids = {
-#     12345678: {
-#         "detected": {
-#               -10012345678: 1512345678
+#     12345678: UserStatus(
+#         detected={
+#             -10012345678: 1512345678
 #         },
-#         "join": {
+#         join={
 #             -10012345678: 1512345678
 #         },
-#         "score": {
-#             "captcha": 0.0,
-#             "clean": 0.0,
-#             "lang": 0.0,
-#             "long": 0.0,
-#             "noflood": 0.0,
-#             "noporn": 0.0,
-#             "nospam": 0.0,
-#             "recheck": 0.0,
-#             "warn": 0.0
-#         }
-#     }
+#         scores=array("d", [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0])
+#     )
 # }
 
 watch_ids: Dict[str, Dict[int, int]] = {
@@ -528,12 +623,24 @@ for word_type in regex:
 #     "regex": 0
 # }
 
+regex_counts: Dict[str, Dict[str, int]] = {word_type: {} for word_type in regex}
+# regex_counts = {
+#     "ad": {
+#         "regex": 0
+#     }
+# }
+
 # Load data
 file_list: List[str] = ["admin_ids", "bad_ids", "except_ids", "trust_ids", "user_ids", "watch_ids",
                         "configs"]
 file_list += [f"{f}_words" for f in regex]
 
-for file in file_list:
+# The regex counts are only kept until they are merged, so they are loaded but not backed up
+for file in file_list + ["regex_counts"]:
+    # The users' data is saved in buckets, the single file of the old versions is only loaded if there are no buckets
+    if file == "user_ids" and (exists("data/user_ids.d") or not (exists("data/user_ids") or exists("data/.user_ids"))):
+        continue
+
     try:
         try:
             if exists(f"data/{file}") or exists(f"data/.{file}"):
@@ -551,6 +658,13 @@ for file in file_list:
         logger.critical(f"Load data {file} backup error: {e}", exc_info=True)
         raise SystemExit("[DATA CORRUPTION]")
 
+# Keep the bad users in the compact set, the data saved by the old versions is a set
+if not isinstance(bad_ids["users"], IdSet):
+    bad_ids["users"] = IdSet(i for i in bad_ids["users"] if isinstance(i, int))
+
+# Keep the users' status in the compact records, the data saved by the old versions is a dict
+user_ids = {uid: UserStatus.from_dict(user_ids[uid]) for uid in user_ids}
+
 # Generate special characters dictionary
 for special in ["spc", "spe"]:
     locals()[f"{special}_dict"]: Dict[str, str] = {}
@@ -570,6 +684,21 @@ for special in ["spc", "spe"]:
         for k in keys:
             locals()[f"{special}_dict"][k] = value
 
+    locals()[f"{special}_table"]: Dict[int, str] = str.maketrans(locals()[f"{special}_dict"])
+
+# Compile regex rules
+compiled_version: int = 1
+
+compiled: Dict[str, Rules] = {}
+# compiled = {
+#     "ad": Rules(version=1, rules=(Rule(word="regex", pattern=re.compile("regex"), nocr=False),))
+# }
+
+for word_type in regex:
+    compiled[word_type] = compile_rules(locals()[f"{word_type}_words"], compiled_version, regex_engine)
+
+compiled_ad: Sweep = compile_sweep({f"ad{c}": compiled[f"ad{c}"] for c in ascii_lowercase}, compiled_version)
+
 # Start program
 copyright_text = (f"SCP-079-{sender} v{version}, Copyright (C) 2019-2020 SCP-079 <https://scp-079.org>\n"
                   "Licensed under the terms of the GNU General Public License v3 or later (GPLv3+)\n")
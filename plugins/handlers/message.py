@@ -23,13 +23,13 @@ from telegram.ext import CallbackContext, Dispatcher, Filters, MessageHandler
 
 from .. import glovar
 from ..functions.channel import get_debug_text
-from ..functions.etc import code, general_link, get_full_name, get_now, get_text, lang, thread, mention_id
+from ..functions.etc import MessageView, code, general_link, get_full_name, get_now, lang, thread, mention_id
 from ..functions.file import save
-from ..functions.filters import authorized_group, captcha_group, class_c, class_d, declared_message, exchange_channel
-from ..functions.filters import from_user, hide_channel, is_class_d_user, is_declared_message, is_long_text, is_nm_text
-from ..functions.filters import new_group, test_group
+from ..functions.filters import Evaluation, authorized_group, captcha_group, class_c, class_d, declared_message
+from ..functions.filters import exchange_channel, from_user, hide_channel, is_class_d_user, is_declared_message
+from ..functions.filters import is_long_text, is_nm_text, new_group, test_group
 from ..functions.group import leave_group
-from ..functions.ids import init_group_id, init_user_id
+from ..functions.ids import init_group_id, init_user_id, update_user_id
 from ..functions.receive import receive_add_bad, receive_add_except, receive_clear_data, receive_config_commit
 from ..functions.receive import receive_config_reply, receive_config_show, receive_declared_message
 from ..functions.receive import receive_leave_approve, receive_refresh, receive_regex, receive_remove_bad
@@ -121,16 +121,13 @@ def captcha(update: Update, context: CallbackContext) -> bool:
         mid = message.message_id
 
         # Get text
-        text = get_text(message)
+        view = MessageView(message)
 
-        if not text.strip():
+        if not view.text.strip():
             return True
 
-        # Get length
-        length = len(text.encode())
-
         # Check length
-        if length < 10000:
+        if view.below(10000):
             return True
 
         # Delete the message
@@ -155,10 +152,12 @@ def check(update: Update, context: CallbackContext) -> bool:
             return True
 
         # Super long message
-        detection = is_long_text(message)
+        evaluation = Evaluation()
+        view = MessageView(message)
+        detection = is_long_text(message, evaluation, view)
 
         if detection:
-            return terminate_user(client, message, detection)
+            return terminate_user(client, message, detection, evaluation, view)
 
         return True
     except Exception as e:
@@ -179,6 +178,7 @@ def check_join(update: Update, context: CallbackContext) -> bool:
         # Basic data
         gid = message.chat.id
         now = int(message.date.strftime("%s")) or get_now()
+        evaluation = Evaluation()
 
         for new in message.new_chat_members:
             # Basic data
@@ -193,7 +193,7 @@ def check_join(update: Update, context: CallbackContext) -> bool:
                 # Check name
                 name = get_full_name(new, True, True)
 
-                if name and is_nm_text(name):
+                if name and is_nm_text(name, evaluation):
                     return True
 
             # Check declare status
@@ -205,8 +205,7 @@ def check_join(update: Update, context: CallbackContext) -> bool:
                 continue
 
             # Update user's join status
-            glovar.user_ids[uid]["join"][gid] = now
-            save("user_ids")
+            update_user_id(uid, "join", gid, now)
 
         return True
     except Exception as e: